@@ -0,0 +1,70 @@
+#! /usr/bin/env python3
+
+# Benchmark the distribution classifier against the old family by family scan
+# Usage: python3 benchmarks/bench_distros.py [number of ISO names]
+
+import sys
+import time
+import random
+from os.path import abspath, dirname, join
+
+sys.path.insert(1, join(dirname(abspath(__file__)), '../usr/lib/usb-creator'))
+from distros import FAMILIES, KeywordMatcher, family_keywords
+
+
+# The old usb-creator logic: first match per family, longer match of a later family wins
+def scan_families(iso_name):
+    iso_name = iso_name.lower()
+    family = ''
+    distro = ''
+    for fam, distros in FAMILIES:
+        for d in distros.split(','):
+            if d in iso_name:
+                if len(d) > len(distro):
+                    family = fam
+                    distro = d
+                break
+    return [family, distro]
+
+
+def iso_names(count, seed=42):
+    rnd = random.Random(seed)
+    keywords = [k for k, f in family_keywords()]
+    parts = ['live', 'desktop', 'amd64', 'i386', 'x86_64', '64bit', '32bit', 'xfce', 'kde', 'mate']
+    names = []
+    for i in range(count):
+        name = [rnd.choice(keywords)]
+        name.append(str(rnd.randint(2010, 2016)))
+        name.extend(rnd.sample(parts, 2))
+        rnd.shuffle(name)
+        names.append("{}.iso".format('-'.join(name)))
+    return names
+
+
+def bench(func, names):
+    start = time.perf_counter()
+    results = [func(name) for name in names]
+    return time.perf_counter() - start, results
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    names = iso_names(count)
+
+    start = time.perf_counter()
+    matcher = KeywordMatcher(family_keywords())
+    compile_time = time.perf_counter() - start
+
+    def classify(name):
+        distro, family = matcher.longest(name)
+        return [family or '', distro or '']
+
+    scan_time, scan_results = bench(scan_families, names)
+    match_time, match_results = bench(classify, names)
+    same = len([1 for a, b in zip(scan_results, match_results) if a == b])
+
+    print(("ISO names:          {}".format(count)))
+    print(("Compile automaton:  {:.2f} ms".format(compile_time * 1000)))
+    print(("Family scan:        {:.2f} ms".format(scan_time * 1000)))
+    print(("Longest match:      {:.2f} ms".format(match_time * 1000)))
+    print(("Same result:        {} of {}".format(same, count)))
@@ -0,0 +1,425 @@
+#! /usr/bin/env python3
+
+# End-to-end benchmark of usb-creator without a real USB stick
+# A sparse image file is attached as a loop device (when running as root and
+# parted and mkfs.vfat are installed) or used as a plain file target.
+# udisks, grub-install and fuser are replaced by shims in a temporary bin
+# directory; in file mode parted, mkfs.vfat, fsck.vfat, blkid, mlabel and
+# e2label are replaced as well.
+#
+# The stages of usr/bin/usb-creator are timed with the progress events it
+# sends (see progress.py) and its timing records are saved with each run.
+# The GUI probes (get_devices and the work done by on_cmbDevice_changed) are
+# timed against a fake sysfs tree.
+#
+# Usage: python3 benchmarks/bench_pipeline.py [options]
+#   --target file|loop|auto   Target to write to (default: auto)
+#   --image-size MB           Size of the sparse image (default: 1024)
+#   --iso-size MB             Size of each test ISO (default: 128)
+#   --isos N                  Number of test ISOs (default: 2)
+#   --runs N                  Number of runs per scenario (default: 3)
+#   --output file.json        Save the results (default: print them)
+#   --compare old.json        Show the difference with earlier results
+#   --keep                    Keep the work directory
+
+import os
+import sys
+import json
+import time
+import select
+import shutil
+import tempfile
+import subprocess
+from os.path import abspath, basename, dirname, exists, join
+from datetime import datetime
+
+REPO_DIR = abspath(join(dirname(abspath(__file__)), '..'))
+LIB_DIR = join(REPO_DIR, 'usr/lib/usb-creator')
+SCRIPT = join(REPO_DIR, 'usr/bin/usb-creator')
+sys.path.insert(1, LIB_DIR)
+from progress import ProgressReader, PROGRESS_FD_ENV, TIMING_STAGE
+from sysdevices import get_devices
+from deviceprobe import probe_device
+from isosize import IsoSizer
+from distros import KeywordMatcher, family_keywords
+from utils import getoutput
+
+DEVICE_NAME = 'sdz'
+LABEL = 'BENCH'
+# Names that are classified by distros.py
+ISO_NAMES = ['linuxmint-18-cinnamon-64bit.iso', 'solydx_8_64_201607.iso',
+             'manjaro-xfce-16.06-x86_64.iso', 'debian-live-8.5.0-amd64-xfce.iso']
+# Scenarios: name and usb-creator arguments (-d and -i are added)
+SCENARIOS = [['full', ['-f', '-b', '-g', '-s', '-u', '-l', LABEL]],
+             ['update', ['-b', '-g', '-s', '-u']]]
+# Number of calls to time a GUI probe
+PROBE_CALLS = 50
+# Fake detachable disks in sysfs next to the benchmark device
+FAKE_DISKS = 8
+
+UDISKS = r'''#!/bin/bash
+# udisks shim: {target} target
+MTAB='{mtab}'
+MOUNTDIR='{mountdir}'
+case "$1" in
+  --enumerate-device-files) echo '{device}' ;;
+  --show-info)
+    echo "  detachable:                  1"
+    if [ "$2" == '{device}' ]; then
+      echo "  partition table:"
+      echo "    scheme:                    mbr"
+    else
+      echo "  usage:                       filesystem"
+      echo "  type:                        vfat"
+    fi
+    ;;
+  --mount)
+    if ! grep -q "^$2 " "$MTAB"; then
+      {mount}
+      echo "$2 $MOUNTDIR vfat rw 0 0" >> "$MTAB"
+    fi
+    echo "Mounted $2 on $MOUNTDIR"
+    ;;
+  --unmount)
+    if grep -q "^$2 " "$MTAB"; then
+      {umount}
+      grep -v "^$2 " "$MTAB" > "$MTAB.new"
+      mv -f "$MTAB.new" "$MTAB"
+    fi
+    ;;
+esac
+exit 0
+'''
+
+GRUB_INSTALL = r'''#!/bin/bash
+# grub-install shim: creates the files usb-creator checks for
+for ARG in "$@"; do
+  case "$ARG" in
+    --target=*) TARGET=${ARG#--target=} ;;
+    --boot-directory=*) BOOTDIR=${ARG#--boot-directory=}; mkdir -p "$BOOTDIR/grub" ;;
+    --efi-directory=*) EFIDIR=${ARG#--efi-directory=} ;;
+    --*) ;;
+    *) DEVICE=$ARG ;;
+  esac
+done
+case "$TARGET" in
+  i386-pc)
+    printf 'GRUB' | dd of="$DEVICE" bs=1 seek=384 conv=notrunc 2>/dev/null
+    mkdir -p "$BOOTDIR/grub/i386-pc"; echo core > "$BOOTDIR/grub/i386-pc/core.img" ;;
+  i386-efi) mkdir -p "$EFIDIR/EFI/BOOT"; touch "$EFIDIR/EFI/BOOT/BOOTIA32.EFI" ;;
+  x86_64-efi) mkdir -p "$EFIDIR/EFI/BOOT"; touch "$EFIDIR/EFI/BOOT/BOOTX64.EFI" ;;
+esac
+exit 0
+'''
+
+# File target: the partition is a directory that is "formatted" by emptying it
+MKFS_FILE = r'''#!/bin/bash
+for PARTITION; do :; done
+find "$PARTITION" -mindepth 1 -delete
+exit 0
+'''
+
+BLKID = r'''#!/bin/bash
+echo '{label}'
+'''
+
+NOOP = '''#!/bin/bash
+exit 0
+'''
+
+
+def write_script(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+    os.chmod(path, 0o755)
+
+
+def has_command(command):
+    return shutil.which(command) is not None
+
+
+# Loop devices need root, losetup and the real partitioning tools
+def loop_available():
+    return os.geteuid() == 0 and all([has_command(c) for c in ['losetup', 'parted', 'mkfs.vfat', 'fsck.vfat']])
+
+
+# Create the test ISOs: random data, so nothing can be skipped or compressed
+def create_isos(iso_dir, count, size_mb):
+    os.makedirs(iso_dir)
+    isos = []
+    for i in range(count):
+        # Every ISO has its own data
+        block = os.urandom(1048576)
+        name = ISO_NAMES[i % len(ISO_NAMES)]
+        if i >= len(ISO_NAMES):
+            name = "{}-{}".format(i, name)
+        path = join(iso_dir, name)
+        with open(path, 'wb') as f:
+            for j in range(size_mb):
+                f.write(block[j:] + block[:j])
+        isos.append(path)
+    return isos
+
+
+# Fake sysfs with the benchmark device and a few other detachable disks
+def create_sysfs(sys_root, image_size_mb):
+    for i in range(FAKE_DISKS + 1):
+        name = DEVICE_NAME if i == 0 else "sd{}".format(chr(ord('b') + i - 1))
+        disk_dir = join(sys_root, 'block', name)
+        os.makedirs(join(disk_dir, name + '1'))
+        with open(join(disk_dir, 'removable'), 'w') as f:
+            f.write('1\n')
+        with open(join(disk_dir, 'size'), 'w') as f:
+            f.write("{}\n".format(image_size_mb * 2048))
+        with open(join(disk_dir, name + '1', 'partition'), 'w') as f:
+            f.write('1\n')
+
+
+class Bench(object):
+    def __init__(self, options):
+        self.options = options
+        self.work_dir = tempfile.mkdtemp(prefix='usb-creator-bench-')
+        self.bin_dir = join(self.work_dir, 'bin')
+        self.dev_dir = join(self.work_dir, 'dev')
+        self.mount_dir = join(self.work_dir, 'mnt')
+        self.sys_root = join(self.work_dir, 'sys')
+        self.mtab = join(self.work_dir, 'mtab')
+        self.log = join(self.work_dir, 'usb-creator.log')
+        self.image = join(self.work_dir, 'usb.img')
+        self.device = join(self.dev_dir, DEVICE_NAME)
+        self.partition = self.device + '1'
+        # Set by setup(): cleanup() can run when setup() failed
+        self.target = None
+        self.loop = None
+        for d in [self.bin_dir, self.dev_dir, self.mount_dir]:
+            os.makedirs(d)
+        open(self.mtab, 'w').close()
+
+    def setup(self):
+        target = self.options['target']
+        if target == 'auto':
+            target = 'loop' if loop_available() else 'file'
+        self.target = target
+        with open(self.image, 'wb') as f:
+            f.truncate(self.options['image_size'] * 1048576)
+
+        if target == 'loop':
+            self.loop = subprocess.check_output(['losetup', '--find', '--show', '--partscan', self.image]).decode().strip()
+            os.symlink(self.loop, self.device)
+            os.symlink(self.loop + 'p1', self.partition)
+            mount = 'mount "$2" "$MOUNTDIR"'
+            umount = 'umount "$2"'
+        else:
+            os.symlink(self.image, self.device)
+            # The partition is mounted on itself
+            self.mount_dir = self.partition
+            os.makedirs(self.partition)
+            mount = ':'
+            umount = ':'
+            write_script(join(self.bin_dir, 'mkfs.vfat'), MKFS_FILE)
+            write_script(join(self.bin_dir, 'blkid'), BLKID.format(label=LABEL))
+            for command in ['parted', 'fsck.vfat', 'mlabel', 'e2label']:
+                write_script(join(self.bin_dir, command), NOOP)
+
+        write_script(join(self.bin_dir, 'udisks'),
+                     UDISKS.format(target=target, mtab=self.mtab, mountdir=self.mount_dir,
+                                   device=self.device, mount=mount, umount=umount))
+        write_script(join(self.bin_dir, 'grub-install'), GRUB_INSTALL)
+        write_script(join(self.bin_dir, 'fuser'), NOOP)
+
+        self.isos = create_isos(join(self.work_dir, 'isos'), self.options['isos'], self.options['iso_size'])
+        create_sysfs(self.sys_root, self.options['image_size'])
+
+    def cleanup(self):
+        if self.loop is not None:
+            subprocess.call(['umount', self.mount_dir], stderr=subprocess.DEVNULL)
+            subprocess.call(['losetup', '--detach', self.loop])
+        if self.options['keep']:
+            print(("Work directory: {}".format(self.work_dir)))
+        else:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def environment(self, progress_fd):
+        env = os.environ.copy()
+        env['PATH'] = "{}:{}".format(self.bin_dir, env.get('PATH', '/usr/bin:/bin'))
+        env['USBCREATOR_LIBDIR'] = LIB_DIR
+        env['USBCREATOR_LOG'] = self.log
+        env['USBCREATOR_MTAB'] = self.mtab
+        env['USBCREATOR_HISTDIR'] = join(self.work_dir, 'history')
+        env[PROGRESS_FD_ENV] = str(progress_fd)
+        return env
+
+    # Run usb-creator once and return the time spent in each stage
+    def run_script(self, args):
+        command = ['bash', SCRIPT, '-d', self.device, '-i', ' '.join(self.isos)] + args
+        if os.geteuid() != 0:
+            # Run as root in a user namespace
+            command = ['unshare', '--user', '--map-root-user'] + command
+        read_fd, write_fd = os.pipe()
+        reader = ProgressReader(read_fd)
+        # [stage, item, start, last event]
+        segments = []
+        # Timing records of the single steps
+        timings = []
+        start = time.monotonic()
+        with open(join(self.work_dir, 'output.log'), 'a') as output:
+            process = subprocess.Popen(command, env=self.environment(write_fd), pass_fds=(write_fd,),
+                                       stdin=subprocess.DEVNULL, stdout=output, stderr=output)
+            os.close(write_fd)
+            while True:
+                select.select([reader], [], [], 0.5)
+                now = time.monotonic()
+                for event in reader.read_events():
+                    if event['stage'] == TIMING_STAGE:
+                        timings.append(event)
+                        continue
+                    item = event.get('item', '')
+                    if not segments or segments[-1][0] != event['stage'] or segments[-1][1] != item:
+                        segments.append([event['stage'], item, now, {}])
+                    segments[-1][3] = event
+                if process.poll() is not None:
+                    break
+        end = time.monotonic()
+        reader.close()
+
+        stages = {}
+        boundaries = [start] + [s[2] for s in segments] + [end]
+        names = ['startup'] + [s[0] for s in segments]
+        for i, name in enumerate(names):
+            stage = stages.setdefault(name, {'seconds': 0.0, 'bytes': 0})
+            stage['seconds'] += boundaries[i + 1] - boundaries[i]
+            if i > 0:
+                stage['bytes'] += segments[i - 1][3].get('total', 0)
+        for stage in stages.values():
+            stage['seconds'] = round(stage['seconds'], 3)
+            if stage['bytes'] and stage['seconds'] > 0:
+                stage['rate'] = round(stage['bytes'] / stage['seconds'] / 1048576, 1)
+        return {'exit_code': process.returncode, 'seconds': round(end - start, 3), 'stages': stages,
+                'timings': timings}
+
+    # The work done for usbcreator.on_cmbDevice_changed without the widgets
+    def probe_device(self, sizer, matcher):
+        snapshot = probe_device(self.device, sizer, self.sys_root, mtab=self.mtab)
+        logos = [matcher.longest(basename(iso))[1] for iso in snapshot['isos']]
+        return [snapshot, logos]
+
+    def run_probes(self):
+        os.environ['PATH'] = "{}:{}".format(self.bin_dir, os.environ.get('PATH', '/usr/bin:/bin'))
+        probes = {}
+        start = time.perf_counter()
+        for i in range(PROBE_CALLS):
+            devices = get_devices(self.sys_root)
+        probes['get_devices'] = {'ms': round((time.perf_counter() - start) * 1000 / PROBE_CALLS, 3),
+                                 'devices': len(devices)}
+        matcher = KeywordMatcher(family_keywords())
+        sizer = IsoSizer()
+        start = time.perf_counter()
+        for i in range(PROBE_CALLS):
+            self.probe_device(sizer, matcher)
+        probes['on_cmbDevice_changed'] = {'ms': round((time.perf_counter() - start) * 1000 / PROBE_CALLS, 3)}
+        getoutput("udisks --unmount {}1".format(self.device))
+        return probes
+
+    def run(self):
+        results = {'version': package_version(),
+                   'date': datetime.now().isoformat(timespec='seconds'),
+                   'target': self.target,
+                   'image_size_mb': self.options['image_size'],
+                   'iso_size_mb': self.options['iso_size'],
+                   'isos': len(self.isos),
+                   'scenarios': {}}
+        for name, args in SCENARIOS:
+            runs = []
+            for i in range(self.options['runs']):
+                # Every run of the full scenario starts with a formatted device
+                runs.append(self.run_script(args))
+                print(("{} run {}: {} s (exit code {})".format(name, i + 1, runs[-1]['seconds'],
+                                                                runs[-1]['exit_code'])), file=sys.stderr)
+            results['scenarios'][name] = {'runs': runs, 'stages': median_stages(runs),
+                                          'seconds': median([r['seconds'] for r in runs])}
+        results['probes'] = self.run_probes()
+        return results
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return 0
+    middle = int(len(values) / 2)
+    if len(values) % 2:
+        return values[middle]
+    return round((values[middle - 1] + values[middle]) / 2, 3)
+
+
+def median_stages(runs):
+    stages = {}
+    for run in runs:
+        for name, stage in run['stages'].items():
+            stages.setdefault(name, []).append(stage['seconds'])
+    return dict([[name, median(seconds)] for name, seconds in stages.items()])
+
+
+def package_version():
+    version = getoutput("git -C '{}' describe --always --dirty 2>/dev/null".format(REPO_DIR))
+    if version and version[0]:
+        return version[0]
+    version = getoutput("dpkg-query -W -f '${Version}' usb-creator 2>/dev/null")
+    return version[0] if version else ''
+
+
+# Print the stage timings next to those of earlier results
+def compare(results, old_results):
+    print(("Compared with {} ({})".format(old_results.get('version', '?'), old_results.get('date', '?'))))
+    for name, scenario in results['scenarios'].items():
+        old_stages = old_results.get('scenarios', {}).get(name, {}).get('stages', {})
+        print(("{}:".format(name)))
+        for stage, seconds in sorted(scenario['stages'].items()):
+            old = old_stages.get(stage)
+            change = ''
+            if old:
+                change = "{:+.0f}%".format((seconds - old) * 100 / old)
+            print(("  {:12} {:9.3f} s  {:>9}  {}".format(stage, seconds, '-' if old is None else old, change)))
+    for probe, values in results['probes'].items():
+        old = old_results.get('probes', {}).get(probe, {}).get('ms')
+        print(("  {:22} {:9.3f} ms {:>9}".format(probe, values['ms'], '-' if old is None else old)))
+
+
+def parse_arguments(args):
+    options = {'target': 'auto', 'image_size': 1024, 'iso_size': 128, 'isos': 2,
+               'runs': 3, 'output': None, 'compare': None, 'keep': False}
+    integers = ['image_size', 'iso_size', 'isos', 'runs']
+    i = 0
+    while i < len(args):
+        key = args[i].lstrip('-').replace('-', '_')
+        if key == 'keep':
+            options['keep'] = True
+        elif key in options and i + 1 < len(args):
+            i += 1
+            options[key] = int(args[i]) if key in integers else args[i]
+        else:
+            sys.exit("Unknown argument: {}".format(args[i]))
+        i += 1
+    if options['target'] not in ('auto', 'file', 'loop'):
+        sys.exit("Unknown target: {}".format(options['target']))
+    if options['target'] == 'loop' and not loop_available():
+        sys.exit("A loop target needs root, losetup, parted, mkfs.vfat and fsck.vfat")
+    return options
+
+
+if __name__ == '__main__':
+    options = parse_arguments(sys.argv[1:])
+    bench = Bench(options)
+    try:
+        bench.setup()
+        results = bench.run()
+    finally:
+        bench.cleanup()
+
+    if options['output']:
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    else:
+        print((json.dumps(results, indent=1, sort_keys=True)))
+    if options['compare'] and exists(options['compare']):
+        with open(options['compare']) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,66 @@
+#! /usr/bin/env python3
+
+# Benchmark filling the ISO list of usb-creator with many rows
+# Compares the old eval based fill (model attached, one eval per row) with
+# TreeViewHandler.fillTreeview: a new fill, a refresh of the same rows
+# (updated by diff) and a refresh with one changed row.
+# Needs Gtk and a display.
+# Usage: python3 benchmarks/bench_treeview.py [number of rows]
+
+import sys
+import time
+from os.path import abspath, dirname, join
+
+sys.path.insert(1, join(dirname(abspath(__file__)), '../usr/lib/usb-creator'))
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk, GdkPixbuf
+from treeview import TreeViewHandler
+
+COLUMN_TYPES = ['bool', 'GdkPixbuf.Pixbuf', 'str', 'str']
+
+
+# The old fill: build and eval Python source for the store and every row
+def fill_eval(treeview, rows):
+    liststore = eval('Gtk.ListStore(bool, GdkPixbuf.Pixbuf, str, str, int, int)')
+    treeview.set_model(liststore)
+    for row in rows:
+        eval('liststore.append([%s, None, "%s", "%s", 400, 10000])' % (row[0], row[2], row[3]))
+
+
+def iso_rows(count, changed=None):
+    rows = []
+    for i in range(count):
+        name = "distro-{}-amd64.iso".format(i)
+        if i == changed:
+            name = "changed-" + name
+        rows.append([False, None, name, "{} MB".format(1000 + i)])
+    return rows
+
+
+def bench(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+if __name__ == '__main__':
+    if not Gtk.init_check(sys.argv)[0]:
+        sys.exit("Gtk cannot be initialized: a display is needed")
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rows = iso_rows(count)
+
+    eval_time = bench(fill_eval, Gtk.TreeView(), rows)
+
+    handler = TreeViewHandler(Gtk.TreeView())
+    fill_time = bench(handler.fillTreeview, rows, COLUMN_TYPES)
+    same_time = bench(handler.fillTreeview, rows, COLUMN_TYPES)
+    changed_time = bench(handler.fillTreeview, iso_rows(count, int(count / 2)), COLUMN_TYPES)
+    append_time = bench(handler.fillTreeview, iso_rows(100), COLUMN_TYPES, 0, 400, False, True)
+
+    print(("Rows:                    {}".format(count)))
+    print(("Eval fill:               {:.1f} ms".format(eval_time)))
+    print(("fillTreeview:            {:.1f} ms".format(fill_time)))
+    print(("Refresh, same rows:      {:.1f} ms".format(same_time)))
+    print(("Refresh, one row change: {:.1f} ms".format(changed_time)))
+    print(("Append 100 rows:         {:.1f} ms".format(append_time)))
@@ -0,0 +1,145 @@
+#! /usr/bin/env python3
+
+# Bootloader fingerprint for usb-creator
+# After grub-install, the fingerprint of every installed target is written
+# to the device. Next time, only the targets whose fingerprint changed (or
+# that were installed by another grub version) are installed again.
+#
+# i386-pc:    boot code in the MBR, the embedding area after the MBR and
+#             boot/grub/i386-pc/core.img
+# i386-efi:   EFI/BOOT/BOOTIA32.EFI
+# x86_64-efi: EFI/BOOT/BOOTX64.EFI
+#
+# Usage:
+#   bootloader.py check /dev/device /mount/point
+#       Print the targets that need to be installed
+#   bootloader.py store /dev/device /mount/point target [...]
+#       Save the fingerprint of the installed targets
+
+import os
+import sys
+import json
+import struct
+import hashlib
+import tempfile
+from os.path import dirname, exists, join
+from utils import getoutput
+
+TARGETS = ['i386-pc', 'i386-efi', 'x86_64-efi']
+FINGERPRINT_FILE = 'boot/grub/usb-creator/bootloader.json'
+EFI_FILES = {'i386-efi': 'EFI/BOOT/BOOTIA32.EFI',
+             'x86_64-efi': 'EFI/BOOT/BOOTX64.EFI'}
+CORE_IMG = 'boot/grub/i386-pc/core.img'
+SECTOR_SIZE = 512
+# Boot code in the MBR, without the disk signature and partition table
+BOOT_CODE_SIZE = 440
+# The core image is embedded between the MBR and the first partition
+MAX_EMBED_SECTORS = 2048
+
+
+# Return the installed grub version
+def grub_version():
+    version = getoutput("dpkg-query -W -f '${Version}' grub2-common 2>/dev/null")
+    if not version or not version[0]:
+        version = getoutput("grub-install --version 2>/dev/null")
+    return version[0] if version else ''
+
+
+def hash_file(path, sha):
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1048576), b''):
+                sha.update(block)
+    except (OSError, IOError):
+        return False
+    return True
+
+
+# Hash the boot code and the embedding area up to the first partition
+def hash_boot_sectors(device, sha):
+    try:
+        with open(device, 'rb') as f:
+            mbr = f.read(SECTOR_SIZE)
+            if len(mbr) < SECTOR_SIZE:
+                return False
+            # Start sector of the first partition (little endian)
+            first = struct.unpack('<I', mbr[454:458])[0]
+            if first < 1 or first > MAX_EMBED_SECTORS:
+                first = MAX_EMBED_SECTORS
+            sha.update(mbr[:BOOT_CODE_SIZE])
+            sha.update(f.read((first - 1) * SECTOR_SIZE))
+    except (OSError, IOError):
+        return False
+    return True
+
+
+# Return the fingerprint of a target or None when it is not installed
+def fingerprint(target, device, mount):
+    sha = hashlib.sha256()
+    if target == 'i386-pc':
+        if not hash_boot_sectors(device, sha) or not hash_file(join(mount, CORE_IMG), sha):
+            return None
+    elif not hash_file(join(mount, EFI_FILES[target]), sha):
+        return None
+    return sha.hexdigest()
+
+
+def load_fingerprints(mount):
+    path = join(mount, FINGERPRINT_FILE)
+    if exists(path):
+        try:
+            with open(path) as f:
+                fingerprints = json.load(f)
+            if isinstance(fingerprints, dict):
+                return fingerprints
+        except (OSError, ValueError):
+            pass
+    return {}
+
+
+# Return the targets that are not installed or not current
+def outdated_targets(device, mount, version=None):
+    if version is None:
+        version = grub_version()
+    saved = load_fingerprints(mount)
+    targets = []
+    for target in TARGETS:
+        current = fingerprint(target, device, mount)
+        entry = saved.get(target, {})
+        if current is None or entry.get('hash') != current or entry.get('version') != version:
+            targets.append(target)
+    return targets
+
+
+# Save the fingerprints of the given targets: keep those of the other targets
+def store_fingerprints(device, mount, targets, version=None):
+    if version is None:
+        version = grub_version()
+    fingerprints = load_fingerprints(mount)
+    for target in targets:
+        current = fingerprint(target, device, mount)
+        if current is None:
+            fingerprints.pop(target, None)
+        else:
+            fingerprints[target] = {'hash': current, 'version': version}
+    path = join(mount, FINGERPRINT_FILE)
+    os.makedirs(dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix='.bootloader', dir=dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(fingerprints, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4 or sys.argv[1] not in ('check', 'store'):
+        sys.stderr.write("Usage: bootloader.py check /dev/device /mount/point\n"
+                         "       bootloader.py store /dev/device /mount/point target [...]\n")
+        sys.exit(2)
+    device, mount = sys.argv[2:4]
+    if sys.argv[1] == 'check':
+        for target in outdated_targets(device, mount):
+            print(target)
+    else:
+        store_fingerprints(device, mount, [t for t in sys.argv[4:] if t in TARGETS])
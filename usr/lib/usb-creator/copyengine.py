@@ -0,0 +1,478 @@
+#! /usr/bin/env python3
+
+# Copy engine for usb-creator
+# Streams a file once in large page aligned buffers and calculates
+# the sha256 hash of the data while it is written to the target.
+#
+# An existing target can be updated in place with --update: only the chunks
+# that differ from the source are written, which saves time and flash wear
+# when a newer build of the same ISO replaces the old one.
+#
+# Usage: copyengine.py /path/to/source.iso /path/to/target[/]
+#        copyengine.py --update /path/to/source.iso /path/to/target[/]
+#        copyengine.py --hash /path/to/file.iso
+#        copyengine.py --verify /path/to/target.iso [bytes]
+#        copyengine.py --image [--zeroed] /path/to/hybrid.iso /dev/device
+# The copy, --update and --image can be preceded by --buffer-size BYTES and
+# --rate MBPS, the buffer size and expected rate from the profile of the
+# device (see stickprofile.py).
+# --verify hashes what is on the device, not what is in the page cache: the
+# cached pages of the file are dropped and it is read with O_DIRECT.
+# --image writes a hybrid ISO or disk image to the device as it is. Blocks
+# of zeros are skipped when the device is known to read zeros there: when
+# --zeroed is given or the device can zero the range without writing it.
+# The sha256 hash of the source is printed to stdout,
+# progress is printed to stderr and sent to the progress channel (progress.py).
+
+import os
+import sys
+import mmap
+import errno
+import stat
+import time
+import fcntl
+import struct
+import hashlib
+from os.path import basename, dirname, isdir, join
+from progress import ProgressWriter
+
+# Buffer size must be a multiple of the page size
+BUFFER_SIZE = 4 * 1024 * 1024
+# Print progress every n percent
+PROGRESS_STEP = 5
+# Chunks that are compared and rewritten when updating a target
+DELTA_CHUNK_SIZE = 1024 * 1024
+# Marker next to a target that is being updated
+UPDATE_SUFFIX = '.updating'
+# Large reads when verifying: a multiple of the logical block size of any device
+VERIFY_BUFFER_SIZE = 16 * 1024 * 1024
+# Sync the device after writing this many bytes of an image
+IMAGE_SYNC_INTERVAL = 64 * 1024 * 1024
+# Blocks of zeros in an image are skipped per block of this size
+ZERO_BLOCK_SIZE = 64 * 1024
+# Block device ioctls (linux/fs.h)
+BLKGETSIZE64 = 0x80081272
+BLKZEROOUT = 0x127f
+
+
+# Return a page aligned, writable buffer
+def aligned_buffer(size=BUFFER_SIZE):
+    return mmap.mmap(-1, size)
+
+
+# Tell the kernel how we are going to read the file
+def advise_sequential(fd):
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+
+# Drop the cached pages of a file (only clean pages can be dropped)
+def drop_cache(fd, offset=0, length=0):
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+
+# Write the complete buffer: os.write can return after a partial write
+def write_all(fd, view):
+    written = 0
+    length = len(view)
+    while written < length:
+        written += os.write(fd, view[written:])
+    return written
+
+
+# Copy source to target and return the sha256 hex digest of the source
+# progress is called with (bytes_done, bytes_total)
+def copy_file(source, target, buffer_size=BUFFER_SIZE, progress=None):
+    if isdir(target):
+        target = join(target, basename(source))
+    sha = hashlib.sha256()
+    buf = aligned_buffer(buffer_size)
+    view = memoryview(buf)
+    src_fd = os.open(source, os.O_RDONLY)
+    try:
+        total = os.fstat(src_fd).st_size
+        advise_sequential(src_fd)
+        dst_fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            done = 0
+            while True:
+                n = os.readv(src_fd, [buf])
+                if n == 0:
+                    break
+                chunk = view[:n]
+                sha.update(chunk)
+                write_all(dst_fd, chunk)
+                done += n
+                if progress is not None:
+                    progress(done, total)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    return sha.hexdigest()
+
+
+# Write the complete buffer at the given offset
+def write_all_at(fd, view, offset):
+    written = 0
+    length = len(view)
+    while written < length:
+        written += os.pwrite(fd, view[written:], offset + written)
+    return written
+
+
+# Read until the buffer is full or the end of the file is reached
+def read_full(fd, view):
+    done = 0
+    while done < len(view):
+        n = os.readv(fd, [view[done:]])
+        if n == 0:
+            break
+        done += n
+    return done
+
+
+def update_marker(target):
+    return "{}{}".format(target, UPDATE_SUFFIX)
+
+
+# Create the update marker and make sure it is on the device
+# before the target is touched
+def write_update_marker(marker, source, size):
+    with open(marker, 'w') as f:
+        f.write("{}\t{}\n".format(source, size))
+        f.flush()
+        os.fsync(f.fileno())
+    sync_directory(dirname(marker))
+
+
+def sync_directory(directory):
+    try:
+        fd = os.open(directory or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# Update target in place: only the chunks that differ from the source are
+# written. While the target is inconsistent, a marker file (target.updating)
+# exists next to it. An interrupted update is finished by running it again.
+# Return [sha256 hex digest of the source, bytes written]
+def update_file(source, target, buffer_size=BUFFER_SIZE, chunk_size=DELTA_CHUNK_SIZE, progress=None):
+    if isdir(target):
+        target = join(target, basename(source))
+    marker = update_marker(target)
+    sha = hashlib.sha256()
+    src_buf = aligned_buffer(buffer_size)
+    src_view = memoryview(src_buf)
+    dst_buf = aligned_buffer(buffer_size)
+    dst_view = memoryview(dst_buf)
+    written = 0
+    src_fd = os.open(source, os.O_RDONLY)
+    try:
+        total = os.fstat(src_fd).st_size
+        advise_sequential(src_fd)
+        write_update_marker(marker, source, total)
+        dst_fd = os.open(target, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            st = os.fstat(dst_fd)
+            advise_sequential(dst_fd)
+            done = 0
+            while True:
+                n = read_full(src_fd, src_view)
+                if n == 0:
+                    break
+                sha.update(src_view[:n])
+                old = read_full(dst_fd, dst_view[:n])
+                for start in range(0, n, chunk_size):
+                    end = min(start + chunk_size, n)
+                    # Slicing the mmap compares much faster than a memoryview
+                    if end > old or src_buf[start:end] != dst_buf[start:end]:
+                        written += write_all_at(dst_fd, src_view[start:end], done + start)
+                done += n
+                if progress is not None:
+                    progress(done, total)
+            # ftruncate changes the mtime even when the size stays the same
+            if st.st_size != done:
+                os.ftruncate(dst_fd, done)
+            os.fsync(dst_fd)
+            if written == 0 and st.st_size == done:
+                # Unchanged: keep the mtime, the Grub menu entry is kept by it
+                os.utime(dst_fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    os.remove(marker)
+    sync_directory(dirname(target))
+    return [sha.hexdigest(), written]
+
+
+# Return the sha256 hex digest of a file
+def hash_file(path, buffer_size=BUFFER_SIZE, progress=None):
+    sha = hashlib.sha256()
+    buf = aligned_buffer(buffer_size)
+    view = memoryview(buf)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        total = os.fstat(fd).st_size
+        advise_sequential(fd)
+        done = 0
+        while True:
+            n = os.readv(fd, [buf])
+            if n == 0:
+                break
+            sha.update(view[:n])
+            done += n
+            if progress is not None:
+                progress(done, total)
+    finally:
+        os.close(fd)
+    return sha.hexdigest()
+
+
+# Read a file back from the device and return [sha256 hex digest, bytes, seconds]
+# Written data is synced and dropped from the page cache first. The file is
+# read with O_DIRECT in page aligned buffers. When the file system does not
+# support O_DIRECT, the cache is dropped behind the reads instead.
+# Only the first length bytes are read when length is given (e.g. the image
+# that was written to a device).
+def verify_file(path, buffer_size=VERIFY_BUFFER_SIZE, progress=None, length=None):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fdatasync(fd)
+        drop_cache(fd)
+    finally:
+        os.close(fd)
+    direct = hasattr(os, 'O_DIRECT')
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECT) if direct else os.open(path, os.O_RDONLY)
+    except OSError:
+        direct = False
+        fd = os.open(path, os.O_RDONLY)
+    sha = hashlib.sha256()
+    buf = aligned_buffer(buffer_size)
+    view = memoryview(buf)
+    start = time.monotonic()
+    done = 0
+    try:
+        total = os.fstat(fd).st_size if length is None else length
+        advise_sequential(fd)
+        while length is None or done < length:
+            try:
+                n = os.readv(fd, [buf])
+            except OSError:
+                if not direct or done > 0:
+                    raise
+                # O_DIRECT is not supported after all
+                direct = False
+                os.close(fd)
+                fd = os.open(path, os.O_RDONLY)
+                advise_sequential(fd)
+                continue
+            if n == 0:
+                break
+            if length is not None:
+                n = min(n, length - done)
+            sha.update(view[:n])
+            if not direct:
+                drop_cache(fd, done, n)
+            done += n
+            if progress is not None:
+                progress(done, total)
+    finally:
+        os.close(fd)
+    return [sha.hexdigest(), done, time.monotonic() - start]
+
+
+# Return the size of a block device or None for other files
+def device_size(fd):
+    if not stat.S_ISBLK(os.fstat(fd).st_mode):
+        return None
+    return struct.unpack('Q', fcntl.ioctl(fd, BLKGETSIZE64, bytes(8)))[0]
+
+
+# Zero the start of a block device when the device can do that without
+# writing the data (write zeroes offload). Return True when it was zeroed.
+def zero_out(fd, length):
+    st = os.fstat(fd)
+    if not stat.S_ISBLK(st.st_mode):
+        return False
+    queue = '/sys/dev/block/{}:{}/queue/write_zeroes_max_bytes'.format(os.major(st.st_rdev), os.minor(st.st_rdev))
+    try:
+        with open(queue) as f:
+            if int(f.read()) == 0:
+                return False
+        fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', 0, length))
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+# Write the blocks of a buffer that are not all zeros at offset
+# Return the number of bytes that were skipped
+def write_non_zero(fd, buf, view, n, offset, zeros):
+    skipped = 0
+    start = None
+    for block in range(0, n, ZERO_BLOCK_SIZE):
+        end = min(block + ZERO_BLOCK_SIZE, n)
+        if buf[block:end] == zeros[:end - block]:
+            if start is not None:
+                write_all_at(fd, view[start:block], offset + start)
+                start = None
+            skipped += end - block
+        elif start is None:
+            start = block
+    if start is not None:
+        write_all_at(fd, view[start:n], offset + start)
+    return skipped
+
+
+# Write an image to a device (or file) as it is
+# The device is synced every sync_interval bytes and the synced pages are
+# dropped from the page cache, so progress follows what is on the device.
+# Return [sha256 hex digest of the image, bytes written, bytes skipped]
+def write_image(source, target, buffer_size=BUFFER_SIZE, sync_interval=IMAGE_SYNC_INTERVAL, zeroed=False, progress=None):
+    sha = hashlib.sha256()
+    buf = aligned_buffer(buffer_size)
+    view = memoryview(buf)
+    zeros = bytes(ZERO_BLOCK_SIZE)
+    skipped = 0
+    src_fd = os.open(source, os.O_RDONLY)
+    try:
+        total = os.fstat(src_fd).st_size
+        advise_sequential(src_fd)
+        if not os.path.exists(target) or os.path.isfile(target):
+            # A new file reads zeros where nothing is written
+            dst_fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            zeroed = True
+        else:
+            # O_EXCL fails when the device is mounted
+            dst_fd = os.open(target, os.O_WRONLY | os.O_EXCL)
+        try:
+            size = device_size(dst_fd)
+            if size is not None and size < total:
+                raise OSError(errno.ENOSPC, "{} is too small for {}".format(target, basename(source)))
+            if not zeroed:
+                zeroed = zero_out(dst_fd, total)
+            done = 0
+            synced = 0
+            while True:
+                n = read_full(src_fd, view)
+                if n == 0:
+                    break
+                sha.update(view[:n])
+                if zeroed:
+                    skipped += write_non_zero(dst_fd, buf, view, n, done, zeros)
+                else:
+                    write_all_at(dst_fd, view[:n], done)
+                done += n
+                if done - synced >= sync_interval or done == total:
+                    os.fdatasync(dst_fd)
+                    drop_cache(dst_fd, synced, done - synced)
+                    synced = done
+                if progress is not None:
+                    progress(done, total)
+            if size is None:
+                # Trailing zeros that were skipped
+                os.ftruncate(dst_fd, done)
+            os.fdatasync(dst_fd)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    return [sha.hexdigest(), done - skipped, skipped]
+
+
+class ProgressPrinter(object):
+    def __init__(self, name, step=PROGRESS_STEP, stream=sys.stderr):
+        self.name = name
+        self.step = step
+        self.stream = stream
+        self.next_percent = 0
+
+    def __call__(self, done, total):
+        percent = int(done * 100 / total) if total > 0 else 100
+        if percent >= self.next_percent:
+            self.stream.write("Copy progress {}: {}%\n".format(self.name, percent))
+            self.stream.flush()
+            self.next_percent = percent + self.step
+
+
+# Call several progress callbacks
+def progress_callbacks(*callbacks):
+    def progress(done, total):
+        for callback in callbacks:
+            callback(done, total)
+    return progress
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    options = {'--buffer-size': str(BUFFER_SIZE), '--rate': '0'}
+    while len(args) > 1 and args[0] in options:
+        options[args[0]] = args[1]
+        args = args[2:]
+    try:
+        # O_DIRECT needs whole pages
+        buffer_size = max(mmap.PAGESIZE, int(options['--buffer-size']) // mmap.PAGESIZE * mmap.PAGESIZE)
+        expected_rate = float(options['--rate'])
+    except ValueError:
+        args = []
+    if len(args) != 2 and not (len(args) == 3 and args[0] in ('--update', '--verify', '--image')) \
+            and not (len(args) == 4 and args[0:2] == ['--image', '--zeroed']):
+        sys.stderr.write("Usage: {0} [--buffer-size BYTES] [--rate MBPS] source target\n"
+                         "       {0} [--buffer-size BYTES] [--rate MBPS] --update source target\n"
+                         "       {0} --hash file\n"
+                         "       {0} --verify file [bytes]\n"
+                         "       {0} [--buffer-size BYTES] [--rate MBPS] --image [--zeroed] image device\n".format(
+                             basename(sys.argv[0])))
+        sys.exit(2)
+    if args[0] == '--hash':
+        path = args[1]
+        print((hash_file(path, progress=ProgressWriter('hash', basename(path)))))
+    elif args[0] == '--verify':
+        path = args[1]
+        length = int(args[2]) if len(args) == 3 else None
+        digest, done, seconds = verify_file(path, progress=ProgressWriter('hash', basename(path)), length=length)
+        rate = done / seconds / 1048576 if seconds > 0 else 0
+        sys.stderr.write("Verified {}: {} MB in {:.1f} s ({:.1f} MB/s)\n".format(basename(path), int(done / 1048576),
+                                                                              seconds, rate))
+        print(digest)
+    elif args[0] == '--image':
+        zeroed = args[1] == '--zeroed'
+        source, target = args[-2:]
+        name = basename(source)
+        progress = progress_callbacks(ProgressPrinter(name), ProgressWriter('copy', name, expected_rate=expected_rate))
+        start = time.monotonic()
+        digest, written, skipped = write_image(source, target, buffer_size, zeroed=zeroed, progress=progress)
+        seconds = time.monotonic() - start
+        rate = (written + skipped) / seconds / 1048576 if seconds > 0 else 0
+        sys.stderr.write("Wrote {} to {}: {} MB written, {} MB of zeros skipped in {:.1f} s ({:.1f} MB/s)\n".format(
+            name, target, int(written / 1048576), int(skipped / 1048576), seconds, rate))
+        print(digest)
+    elif args[0] == '--update':
+        source = args[1]
+        name = basename(source)
+        progress = progress_callbacks(ProgressPrinter(name), ProgressWriter('copy', name, expected_rate=expected_rate))
+        digest, written = update_file(source, args[2], buffer_size, progress=progress)
+        sys.stderr.write("Updated {}: {} MB of {} MB written\n".format(name, int(written / 1048576),
+                                                                       int(os.stat(source).st_size / 1048576)))
+        print(digest)
+    else:
+        source = args[0]
+        name = basename(source)
+        progress = progress_callbacks(ProgressPrinter(name), ProgressWriter('copy', name, expected_rate=expected_rate))
+        print((copy_file(source, args[1], buffer_size, progress=progress)))
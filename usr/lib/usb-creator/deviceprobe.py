@@ -0,0 +1,148 @@
+#! /usr/bin/env python3
+
+# Background device probe for usb-creator
+# Mounting a slow stick and reading its free space and ISOs can take
+# seconds: a worker thread does this and returns a snapshot of the device:
+#   {'path': '/dev/sdb', 'size': kB, 'has_partition': True,
+#    'mount': '/media/user/MULTIUSB', 'available': kB or None,
+#    'isos': {'/media/user/MULTIUSB/solydx.iso': kB}}
+# A new request cancels the probe that is running. Snapshots are cached
+# per device until they are invalidated (e.g. by a uevent).
+# When the probe fails (e.g. the device was removed) an empty snapshot with
+# the error is returned: {'path': ..., ..., 'error': 'message'}. It is not cached.
+
+import threading
+from queue import Queue
+from os.path import exists
+from utils import getoutput
+from isosize import IsoSizer
+from sysdevices import SYS_ROOT, get_device_info
+
+MTAB = '/etc/mtab'
+
+
+class ProbeCancelled(Exception):
+    pass
+
+
+# Mount the first partition of a device and return its mount point
+def get_device_mount(device, mtab=MTAB):
+    getoutput("udisks --mount {}1".format(device))
+    mount = getoutput("grep %s1 %s | awk '{print $2}' | sed 's/\\040/ /g'" % (device, mtab))
+    if mount:
+        return mount[0]
+    return ''
+
+
+# Return the free space of the first partition in kB or None
+def get_free_size(device):
+    free_size = getoutput("df --output=avail {}1 | awk 'NR==2'".format(device))
+    if free_size and free_size[0].isdigit():
+        return int(free_size[0])
+    return None
+
+
+def empty_snapshot(device):
+    return {'path': device,
+            'size': 0,
+            'has_partition': False,
+            'mount': '',
+            'available': None,
+            'isos': {}}
+
+
+# Return the snapshot of a device
+# check is called between the steps and raises ProbeCancelled to stop
+def probe_device(device, iso_sizer, sys_root=SYS_ROOT, check=None, mtab=MTAB):
+    def checkpoint():
+        if check is not None:
+            check()
+
+    info = get_device_info(device, sys_root)
+    snapshot = empty_snapshot(device)
+    snapshot['size'] = int(info['size'] / 1024)
+    snapshot['has_partition'] = info['has_partition']
+    if info['has_partition']:
+        checkpoint()
+        snapshot['mount'] = get_device_mount(device, mtab)
+        checkpoint()
+        snapshot['available'] = get_free_size(device)
+        checkpoint()
+        if exists(snapshot['mount']):
+            snapshot['isos'] = iso_sizer.scan_dir(snapshot['mount'])
+    return snapshot
+
+
+# Worker thread that probes one device at a time
+# deliver is used to call the callbacks, e.g. GLib.idle_add to run them
+# on the main loop
+# The owner starts the thread once, before the first probe
+class DeviceProber(threading.Thread):
+    def __init__(self, deliver=None, sys_root=SYS_ROOT):
+        super(DeviceProber, self).__init__()
+        self.daemon = True
+        self.deliver = deliver
+        self.sys_root = sys_root
+        self.requests = Queue()
+        self.lock = threading.Lock()
+        # Increased with every request: older probes are cancelled
+        self.generation = 0
+        self.cache = {}
+        self.iso_sizer = IsoSizer()
+
+    # Return the cached snapshot of a device or None
+    def get_cached(self, device):
+        with self.lock:
+            return self.cache.get(device)
+
+    # Drop the snapshot of a device or of all devices
+    def invalidate(self, device=None):
+        with self.lock:
+            if device is None:
+                self.cache = {}
+            else:
+                self.cache.pop(device, None)
+
+    # Probe a device in the background and call callback(snapshot)
+    def probe(self, device, callback):
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+        self.requests.put([generation, device, callback])
+
+    # Stop the probe that is running without starting a new one
+    def cancel(self):
+        with self.lock:
+            self.generation += 1
+
+    def is_current(self, generation):
+        with self.lock:
+            return generation == self.generation
+
+    def run(self):
+        while True:
+            generation, device, callback = self.requests.get()
+            if not self.is_current(generation):
+                continue
+
+            def check():
+                if not self.is_current(generation):
+                    raise ProbeCancelled()
+
+            try:
+                snapshot = probe_device(device, self.iso_sizer, self.sys_root, check)
+            except ProbeCancelled:
+                continue
+            except Exception as detail:
+                # Keep the worker alive for the next request
+                snapshot = empty_snapshot(device)
+                snapshot['error'] = str(detail)
+            with self.lock:
+                if generation != self.generation:
+                    continue
+                if 'error' not in snapshot:
+                    self.cache[device] = snapshot
+            if self.deliver is not None:
+                self.deliver(callback, snapshot)
+            else:
+                callback(snapshot)
@@ -227,3 +227,42 @@ class InputDialog(Gtk.MessageDialog):
             return ''
         finally:
             self.destroy()
+
+
+# Select one or more values with check buttons
+# Usage:
+# devices = CheckListDialog(_("My Title"), "Your message here", ['/dev/sdb', '/dev/sdc'], ['/dev/sdb']).show()
+class CheckListDialog(Gtk.MessageDialog):
+    def __init__(self, title, text, values, selected_values=[], parent=None):
+        parent = parent or next((w for w in Gtk.Window.list_toplevels() if w.get_title()), None)
+
+        Gtk.MessageDialog.__init__(self, parent,
+                                   Gtk.DialogFlags.MODAL | Gtk.DialogFlags.DESTROY_WITH_PARENT,
+                                   Gtk.MessageType.QUESTION, Gtk.ButtonsType.OK_CANCEL, text)
+
+        self.set_position(Gtk.WindowPosition.CENTER)
+        if parent is not None:
+            self.set_icon(parent.get_icon())
+        self.set_title(title)
+        self.set_markup(text)
+
+        # Add a check button for each value
+        self.check_buttons = []
+        for value in values:
+            chk = Gtk.CheckButton(label=str(value))
+            chk.set_active(value in selected_values)
+            self.vbox.pack_start(chk, False, False, 0)
+            self.check_buttons.append([chk, value])
+        self.vbox.show_all()
+
+        self.set_default_response(Gtk.ResponseType.OK)
+
+    # Returns the list of checked values or None when cancelled
+    def show(self):
+        try:
+            result = self.run()
+            if result == Gtk.ResponseType.OK:
+                return [value for chk, value in self.check_buttons if chk.get_active()]
+            return None
+        finally:
+            self.destroy()
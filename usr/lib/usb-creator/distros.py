@@ -0,0 +1,151 @@
+#! /usr/bin/env python3
+
+# Distribution classifier for usb-creator
+# Used by usb-creator to create the Grub menu and by the GUI to find the logo
+# of an ISO. All keywords are compiled into one Aho-Corasick automaton that
+# returns the longest keyword found in the ISO name in a single pass.
+# On equal length, the keyword of the first family (and first in its list) wins.
+#
+# When the ISO name does not contain a known distribution, the root
+# directories of the ISO (see isometa.py) are used to guess the family.
+#
+# Usage: distros.py [--cache /path/to/isometa.json] /path/to/your.iso [...]
+# Prints "path<tab>family<tab>distro<tab>volume id" for every ISO.
+# Unknown values are printed as "-".
+
+import sys
+from os.path import basename
+from isometa import IsoMetaCache, parse_cache_argument
+
+# ================================================================
+# Distributions families
+# Source: http://distrowatch.com/search.php   select: "Based on"
+# ================================================================
+FAMILIES = [
+    ['ubuntu', 'untu,aurora,mint,asturix,backbox,bio,bodhi,deepin,peasy,sense,joli,linuxgfx,kuki,linuxmce,netrunner,peppermint,pinguy,poseidon,puredyne,qimo,startos,trisquel,uberstudent,remix,ultimate,vinux,zentyal,zeven,lxle,zorin,elementary,lite,chromixium,mangaka,watt,voyager,kylin,extix,emma,chalet,caine,symphony,superx,artisx,bella,apodio,luninux,remnux,lliurex,leeenux,kxstudio,peach,deft,salent,caelinux,madbox,nova,baltix,bardinux,lunuxfx,greenie,centrych,caixa,openlx,guadalinex,max,ulteo,karoshi,nexenta,chitwanix,track,bll,lab'],
+    ['debian', 'debian,mini,kali,antix,steamos,q4os,tails,robo,sparky,makulu,tanglu,zilla,handy,neptune,semplice,gparted,solyd,parsix,elive,avlinux,univention,siduction,turnkey,point,galpon,proxmox,openmedia,2xos,webconverger,finnix,blankon,linuxbbq,untangle,boss,pardus,musix,rebellin,kanotix,gnewsense,matriux,skole,exe,vyos,kwheezy,doudou,window,parrot,canaima,volumio,selks,osmc,grml,pelicanhpc,linex,omoikane,catix,lmde'],
+    ['arch', 'arch,manjaro,antergos,chakra,blackarch,bridge,parabola,poliarch,kademar,linhes,kaos'],
+    ['puppy', 'puppy,simplicity,legacy,toutou,quirky'],
+    ['knoppix', 'knoppix,overclockix'],
+    ['centos', 'centos,baruwa,sme,asterisknow,stella,elastix,rockstor'],
+    ['fedora', 'fedora,korora,qubes,nst,linpus,blag,vortexbox,chapeau,hanthana,xange,olpc,sulix,ojuba'],
+    ['suse', 'suse,netsecl'],
+    ['gentoo', 'gentoo,sabayon,calculate,rescue,kiosk,funtoo,pentoo,exherbo,bicom'],
+    ['slack', 'slack,vector,vl,absolute,salix,wifislax,porteus,slackel,connochaet,austrumi,zenwalk,plamo,superb'],
+    ['mandriva', 'mandriva,mageia,blackpanther,unity'],
+    ['independent', 'pclinux,solus,4mlinux,magic'],
+]
+
+
+# Aho-Corasick automaton that returns the longest matching keyword
+# keywords: list of [keyword, value] in order of priority
+class KeywordMatcher(object):
+    def __init__(self, keywords):
+        # Every state: [transitions, fail state, best [length, -priority, keyword, value] or None]
+        self.states = [[{}, 0, None]]
+        for priority, (keyword, value) in enumerate(keywords):
+            if keyword:
+                self.add(keyword.lower(), priority, value)
+        self.build()
+
+    def add(self, keyword, priority, value):
+        state = 0
+        for char in keyword:
+            nxt = self.states[state][0].get(char)
+            if nxt is None:
+                nxt = len(self.states)
+                self.states.append([{}, 0, None])
+                self.states[state][0][char] = nxt
+            state = nxt
+        candidate = [len(keyword), -priority, keyword, value]
+        if self.states[state][2] is None or candidate[:2] > self.states[state][2][:2]:
+            self.states[state][2] = candidate
+
+    # Breadth first: set the fail links and propagate the best output
+    def build(self):
+        queue = list(self.states[0][0].values())
+        i = 0
+        while i < len(queue):
+            state = queue[i]
+            i += 1
+            transitions, fail, best = self.states[state]
+            fail_best = self.states[fail][2]
+            if fail_best is not None and (best is None or fail_best[:2] > best[:2]):
+                self.states[state][2] = fail_best
+            for char, nxt in transitions.items():
+                f = fail
+                while f and char not in self.states[f][0]:
+                    f = self.states[f][1]
+                target = self.states[f][0].get(char, 0)
+                self.states[nxt][1] = target if target != nxt else 0
+                queue.append(nxt)
+
+    # Return [keyword, value] of the longest keyword in text or [None, None]
+    def longest(self, text):
+        states = self.states
+        state = 0
+        best = None
+        for char in text.lower():
+            while state and char not in states[state][0]:
+                state = states[state][1]
+            state = states[state][0].get(char, 0)
+            found = states[state][2]
+            if found is not None and (best is None or found[:2] > best[:2]):
+                best = found
+        if best is None:
+            return [None, None]
+        return [best[2], best[3]]
+
+
+# Return the keywords of all families: [[distro, family], ...]
+def family_keywords(families=FAMILIES):
+    keywords = []
+    for family, distros in families:
+        for distro in distros.split(','):
+            keywords.append([distro.strip(), family])
+    return keywords
+
+
+# Root directory of an ISO: [family, distro]
+CONTENT_FAMILIES = [
+    ['casper', ['ubuntu', 'casper']],
+    ['live', ['debian', 'live']],
+    ['arch', ['arch', 'arch']],
+]
+
+_matcher = None
+
+
+# Return [family, distro] of an ISO name or ['', ''] when unknown
+def classify(iso_name):
+    global _matcher
+    if _matcher is None:
+        _matcher = KeywordMatcher(family_keywords())
+    distro, family = _matcher.longest(basename(iso_name))
+    if distro is None:
+        return ['', '']
+    return [family, distro]
+
+
+# Return [family, distro] from the ISO metadata or ['', '']
+def classify_content(meta):
+    if meta is not None:
+        for directory, family_distro in CONTENT_FAMILIES:
+            if directory in meta['known_dirs']:
+                return family_distro
+    return ['', '']
+
+
+if __name__ == '__main__':
+    cache_file, isos = parse_cache_argument(sys.argv[1:])
+    cache = IsoMetaCache(cache_file)
+    for iso in isos:
+        meta = cache.get(iso)
+        family, distro = classify(iso)
+        if not family:
+            family, distro = classify_content(meta)
+        volume_id = '-'
+        if meta is not None and meta['volume_id']:
+            volume_id = meta['volume_id'].split()[0]
+        print(("{}\t{}\t{}\t{}".format(iso, family or '-', distro or '-', volume_id)))
+    cache.save()
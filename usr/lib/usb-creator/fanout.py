@@ -0,0 +1,229 @@
+#! /usr/bin/env python3
+
+# Fan-out copy for usb-creator
+# Reads a source ISO once and writes it to several targets at the same time.
+# Every target has its own writer thread. When a writer falls behind, it is
+# detached from the shared stream and catches up by reading the source itself,
+# so a slow stick never stalls the others. A failing stick only fails itself.
+# An existing target is updated in place, as copyengine.py --update does: only
+# the chunks that differ are written and the update marker is kept when the
+# update fails.
+#
+# Usage: fanout.py [--verify] [--buffer-size BYTES] [--queue-depth N]
+#                  /path/to/source.iso /target1/ [/target2/ ...]
+# The buffer size and queue depth come from the profiles of the target
+# devices (see stickprofile.py).
+# Output (tab separated, one line per target):
+#   source    <sha256>
+#   <target>  OK|MISMATCH|FAILED  <sha256 or error>
+
+import os
+import sys
+import hashlib
+import threading
+from queue import Queue, Full, Empty
+from os.path import basename, dirname, exists, isdir, join
+from copyengine import BUFFER_SIZE, DELTA_CHUNK_SIZE, verify_file, write_all, write_all_at, \
+                       advise_sequential, update_marker, write_update_marker, sync_directory
+from progress import ProgressWriter
+
+# Number of buffers a writer may lag behind before it is detached
+QUEUE_DEPTH = 16
+# Seconds between progress reports while the writers catch up
+PROGRESS_INTERVAL = 0.5
+
+
+class TargetWriter(threading.Thread):
+    def __init__(self, source, target, buffer_size=BUFFER_SIZE, queue_depth=QUEUE_DEPTH, verify=False):
+        super(TargetWriter, self).__init__()
+        self.source = source
+        self.target = join(target, basename(source)) if isdir(target) else target
+        self.buffer_size = buffer_size
+        self.queue = Queue(queue_depth)
+        self.verify = verify
+        self.daemon = True
+        self.detached = False
+        self.sha = hashlib.sha256()
+        self.offset = 0
+        self.written = 0
+        self.update = exists(self.target)
+        self.error = None
+        self.target_hash = None
+
+    # Called by the reader: returns False when this writer no longer takes data
+    def feed(self, chunk):
+        if self.detached or self.error is not None:
+            return False
+        try:
+            self.queue.put_nowait(chunk)
+            return True
+        except Full:
+            # Too slow: stop feeding and let the writer catch up on its own
+            self.detached = True
+            return False
+
+    def run(self):
+        try:
+            if self.update:
+                self.update_target()
+            else:
+                fd = os.open(self.target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    self.write_stream(fd)
+                    os.fdatasync(fd)
+                finally:
+                    os.close(fd)
+            if self.verify:
+                self.target_hash = verify_file(self.target)[0]
+        except Exception as detail:
+            self.error = str(detail)
+            self.detached = True
+
+    # Update the existing target in place while the marker exists
+    def update_target(self):
+        marker = update_marker(self.target)
+        write_update_marker(marker, self.source, os.stat(self.source).st_size)
+        fd = os.open(self.target, os.O_RDWR)
+        try:
+            st = os.fstat(fd)
+            self.write_stream(fd)
+            # ftruncate changes the mtime even when the size stays the same
+            if st.st_size != self.offset:
+                os.ftruncate(fd, self.offset)
+            os.fdatasync(fd)
+            if self.written == 0 and st.st_size == self.offset:
+                # Unchanged: keep the mtime, the Grub menu entry is kept by it
+                os.utime(fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+        finally:
+            os.close(fd)
+        os.remove(marker)
+        sync_directory(dirname(self.target))
+
+    def write_stream(self, fd):
+        while True:
+            try:
+                chunk = self.queue.get(timeout=0.1)
+            except Empty:
+                if self.detached:
+                    # All queued data is written: read the rest ourselves
+                    self.catch_up(fd)
+                    return
+                continue
+            if chunk is None:
+                return
+            self.write_chunk(fd, chunk)
+
+    def catch_up(self, fd):
+        src_fd = os.open(self.source, os.O_RDONLY)
+        try:
+            advise_sequential(src_fd)
+            os.lseek(src_fd, self.offset, os.SEEK_SET)
+            while True:
+                chunk = os.read(src_fd, self.buffer_size)
+                if not chunk:
+                    break
+                self.write_chunk(fd, chunk)
+        finally:
+            os.close(src_fd)
+
+    def write_chunk(self, fd, chunk):
+        if self.update:
+            # Only write the chunks that differ from the target
+            n = len(chunk)
+            old = os.pread(fd, n, self.offset)
+            view = memoryview(chunk)
+            for start in range(0, n, DELTA_CHUNK_SIZE):
+                end = min(start + DELTA_CHUNK_SIZE, n)
+                if end > len(old) or chunk[start:end] != old[start:end]:
+                    self.written += write_all_at(fd, view[start:end], self.offset + start)
+        else:
+            self.written += write_all(fd, chunk)
+        self.sha.update(chunk)
+        self.offset += len(chunk)
+
+
+# Return the bytes that all writers that did not fail have written
+def written_position(writers, default):
+    positions = [writer.offset for writer in writers if writer.error is None]
+    return min(positions) if positions else default
+
+
+# Copy source to all targets
+# progress is called with the position of the slowest writer, not of the reader
+# Returns the sha256 of the source and the list of writers
+def fanout_copy(source, targets, buffer_size=BUFFER_SIZE, verify=False, progress=None, queue_depth=QUEUE_DEPTH):
+    writers = [TargetWriter(source, target, buffer_size, queue_depth, verify) for target in targets]
+    for writer in writers:
+        writer.start()
+
+    sha = hashlib.sha256()
+    fd = os.open(source, os.O_RDONLY)
+    try:
+        total = os.fstat(fd).st_size
+        advise_sequential(fd)
+        done = 0
+        while True:
+            chunk = os.read(fd, buffer_size)
+            if not chunk:
+                break
+            sha.update(chunk)
+            for writer in writers:
+                writer.feed(chunk)
+            done += len(chunk)
+            if progress is not None:
+                progress(written_position(writers, done), total)
+    finally:
+        os.close(fd)
+
+    # Signal the end of the stream to the writers that are still attached
+    # A writer with a full queue is detached and finds the end of the source itself
+    for writer in writers:
+        writer.feed(None)
+    for writer in writers:
+        while writer.is_alive():
+            writer.join(PROGRESS_INTERVAL)
+            if progress is not None:
+                progress(written_position(writers, done), total)
+    return sha.hexdigest(), writers
+
+
+# Return the status of a writer: OK, MISMATCH or FAILED
+def writer_status(writer, source_hash):
+    if writer.error is not None:
+        return 'FAILED', writer.error
+    written_hash = writer.sha.hexdigest()
+    if written_hash != source_hash:
+        return 'MISMATCH', written_hash
+    if writer.verify and writer.target_hash != source_hash:
+        return 'MISMATCH', writer.target_hash
+    return 'OK', written_hash
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    verify = False
+    options = {'--buffer-size': str(BUFFER_SIZE), '--queue-depth': str(QUEUE_DEPTH)}
+    while args and (args[0] == '--verify' or (len(args) > 1 and args[0] in options)):
+        if args[0] == '--verify':
+            verify = True
+            args = args[1:]
+        else:
+            options[args[0]] = args[1]
+            args = args[2:]
+    if len(args) < 2 or not options['--buffer-size'].isdigit() or not options['--queue-depth'].isdigit():
+        sys.stderr.write("Usage: {} [--verify] [--buffer-size BYTES] [--queue-depth N] source target [target ...]\n"
+                         .format(basename(sys.argv[0])))
+        sys.exit(2)
+    buffer_size = max(1, int(options['--buffer-size']))
+    queue_depth = max(1, int(options['--queue-depth']))
+
+    progress = ProgressWriter('copy', basename(args[0]))
+    source_hash, writers = fanout_copy(args[0], args[1:], buffer_size, verify, progress, queue_depth)
+    print(("source\t{}".format(source_hash)))
+    ret = 0
+    for target, writer in zip(args[1:], writers):
+        status, detail = writer_status(writer, source_hash)
+        print(("{}\t{}\t{}".format(target, status, detail)))
+        if status != 'OK':
+            ret = 1
+    sys.exit(ret)
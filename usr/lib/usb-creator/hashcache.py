@@ -0,0 +1,150 @@
+#! /usr/bin/env python3
+
+# Persistent sha256 cache for source ISOs
+# Entries are keyed by (device, inode, size, mtime_ns) of the ISO:
+# when the ISO is replaced or changed, the key changes and the old entry
+# is dropped the next time the cache is saved.
+#
+# Usage:
+#   hashcache.py hash /path/to/cache.json /path/to/your.iso
+#       Print the cached hash or calculate and cache it
+#   hashcache.py store /path/to/cache.json /path/to/your.iso HASH
+#       Cache a hash that was calculated elsewhere (e.g. by the copy engine)
+
+import os
+import sys
+import json
+import fcntl
+import tempfile
+from os.path import abspath, basename, dirname, exists
+from copyengine import hash_file
+
+
+# Return the cache key of a file or None if it does not exist
+def stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return "{}:{}:{}:{}".format(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class HashCache(object):
+    def __init__(self, cache_file):
+        self.cache_file = abspath(cache_file)
+        self.lock_file = "{}.lock".format(self.cache_file)
+        self.lock_fd = None
+        self.entries = {}
+
+    # Hold an exclusive lock while reading and writing:
+    # the GUI and the terminal can run usb-creator at the same time
+    def __enter__(self):
+        self.lock_fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        self.set_owner(self.lock_file)
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        self.load()
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+        os.close(self.lock_fd)
+        self.lock_fd = None
+
+    def load(self):
+        self.entries = {}
+        if exists(self.cache_file):
+            try:
+                with open(self.cache_file) as f:
+                    entries = json.load(f)
+                if isinstance(entries, dict):
+                    self.entries = entries
+            except (OSError, ValueError):
+                # Corrupt cache: start over
+                self.entries = {}
+
+    # Atomically replace the cache file
+    def save(self):
+        # Drop entries of ISOs that were changed or removed
+        for key in list(self.entries.keys()):
+            if stat_key(self.entries[key]['path']) != key:
+                del self.entries[key]
+        fd, tmp = tempfile.mkstemp(prefix='.hashcache', dir=dirname(self.cache_file))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp, 0o644)
+            self.set_owner(tmp)
+            os.rename(tmp, self.cache_file)
+        except:
+            if exists(tmp):
+                os.remove(tmp)
+            raise
+
+    # usb-creator runs as root: keep the cache owned by the user
+    def set_owner(self, path):
+        if os.geteuid() == 0:
+            st = os.stat(dirname(self.cache_file))
+            os.chown(path, st.st_uid, st.st_gid)
+
+    def get(self, path):
+        key = stat_key(path)
+        if key is not None:
+            entry = self.entries.get(key)
+            if entry is not None:
+                return entry['sha256']
+        return None
+
+    def set(self, path, sha256):
+        key = stat_key(path)
+        if key is not None:
+            self.entries[key] = {'path': abspath(path), 'sha256': sha256}
+
+
+# Return the cached hash or calculate it
+# The lock is not held while hashing: that can take minutes
+# A cache that cannot be read or written (e.g. a full disk) is skipped:
+# the hash is still returned
+def cached_hash(cache_file, path):
+    cache = HashCache(cache_file)
+    sha256 = None
+    try:
+        with cache:
+            sha256 = cache.get(path)
+    except OSError as detail:
+        sys.stderr.write("Cannot read the hash cache {}: {}\n".format(cache_file, detail))
+    if sha256 is None:
+        key = stat_key(path)
+        sha256 = hash_file(path)
+        # Do not cache when the file changed while hashing
+        if stat_key(path) == key:
+            try:
+                with cache:
+                    cache.set(path, sha256)
+                    cache.save()
+            except OSError as detail:
+                sys.stderr.write("Cannot save the hash cache {}: {}\n".format(cache_file, detail))
+    return sha256
+
+
+def usage():
+    sys.stderr.write("Usage: {0} hash CACHE ISO\n"
+                     "       {0} store CACHE ISO HASH\n".format(basename(sys.argv[0])))
+    sys.exit(2)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        usage()
+    action = sys.argv[1]
+    cache_file = sys.argv[2]
+    iso = sys.argv[3]
+    if action == 'hash':
+        print((cached_hash(cache_file, iso)))
+    elif action == 'store' and len(sys.argv) == 5:
+        with HashCache(cache_file) as cache:
+            cache.set(iso, sys.argv[4])
+            cache.save()
+    else:
+        usage()
@@ -0,0 +1,118 @@
+#! /usr/bin/env python3
+
+# Parallel sha256 check of the ISOs on a device
+# The source ISOs are hashed (or taken from the hash cache, see hashcache.py)
+# while their copies are read back from the device (see copyengine.py
+# --verify), in a pool of worker processes.
+# The files are spread over lanes per device: a lane is read by one worker,
+# one file after the other. A USB stick gets one lane: it is read fastest
+# sequentially. The other devices share the remaining cores.
+#
+# Usage: hashpipeline.py /path/to/cache.json /mount/point /path/to/your.iso [...]
+# Prints "iso<tab>source hash<tab>target hash" for every ISO, in the given
+# order. A hash that could not be calculated is printed as "-".
+
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from os.path import basename, join
+from copyengine import verify_file
+from hashcache import cached_hash
+from progress import ProgressWriter
+
+# Lanes of the device that is verified
+TARGET_LANES = 1
+
+
+def file_device(path):
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+def file_size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+# Spread the files over lanes: largest first, to the lane with the fewest bytes
+def split_lanes(paths, lane_count):
+    lanes = [[0, []] for i in range(max(1, min(lane_count, len(paths))))]
+    for path in sorted(paths, key=file_size, reverse=True):
+        lane = min(lanes, key=lambda lane: lane[0])
+        lane[0] += file_size(path)
+        lane[1].append(path)
+    return [lane[1] for lane in lanes]
+
+
+# Group the files per device: {device: [path, ...]}
+def group_by_device(paths):
+    devices = {}
+    for path in paths:
+        devices.setdefault(file_device(path), []).append(path)
+    return devices
+
+
+# Worker: hash the files of a lane one after the other
+# Returns [[kind, path, hash or None], ...]
+def hash_lane(kind, paths, cache_file):
+    hashes = []
+    for path in paths:
+        try:
+            if kind == 'target':
+                sha256, done, seconds = verify_file(path, progress=ProgressWriter('hash', basename(path)))
+                rate = done / seconds / 1048576 if seconds > 0 else 0
+                sys.stderr.write("Verified {}: {} MB in {:.1f} s ({:.1f} MB/s)\n".format(
+                    basename(path), int(done / 1048576), seconds, rate))
+            else:
+                sha256 = cached_hash(cache_file, path)
+        except OSError as detail:
+            sys.stderr.write("Cannot hash {}: {}\n".format(path, detail))
+            sha256 = None
+        hashes.append([kind, path, sha256])
+    return hashes
+
+
+# Return the lanes to hash: [[kind, [path, ...]], ...]
+def plan_lanes(isos, targets, cpus=None):
+    if cpus is None:
+        cpus = os.cpu_count() or 1
+    lanes = []
+    target_devices = group_by_device(targets)
+    for paths in target_devices.values():
+        lanes.extend([['target', lane] for lane in split_lanes(paths, TARGET_LANES)])
+    source_devices = group_by_device(isos)
+    # The cores that are not used to read the targets
+    per_device = max(1, int((cpus - len(lanes)) / max(1, len(source_devices))))
+    for paths in source_devices.values():
+        lanes.extend([['source', lane] for lane in split_lanes(paths, per_device)])
+    return lanes
+
+
+# Return {iso: [source hash, target hash]}
+def hash_isos(cache_file, mount, isos, cpus=None):
+    targets = [join(mount, basename(iso)) for iso in isos]
+    lanes = plan_lanes(isos, targets, cpus)
+    hashes = {}
+    with ProcessPoolExecutor(max_workers=max(1, min(cpus or os.cpu_count() or 1, len(lanes)))) as executor:
+        # The target lanes take longest: start them first
+        futures = [executor.submit(hash_lane, kind, paths, cache_file) for kind, paths in lanes]
+        for future in futures:
+            for kind, path, sha256 in future.result():
+                hashes[(kind, path)] = sha256
+    return dict((iso, [hashes.get(('source', iso)), hashes.get(('target', target))])
+                for iso, target in zip(isos, targets))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        sys.stderr.write("Usage: {} CACHE MOUNT ISO [...]\n".format(basename(sys.argv[0])))
+        sys.exit(2)
+    cache_file, mount, isos = sys.argv[1], sys.argv[2], sys.argv[3:]
+    hashes = hash_isos(cache_file, mount, isos)
+    for iso in isos:
+        source, target = hashes[iso]
+        print(("{}\t{}\t{}".format(iso, source or '-', target or '-')))
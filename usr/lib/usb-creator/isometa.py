@@ -0,0 +1,179 @@
+#! /usr/bin/env python3
+
+# ISO9660 metadata reader for usb-creator
+# Reads the volume id and the names in the root directory of an ISO without
+# spawning isoinfo. Only the primary volume descriptor and the root directory
+# extent are read (mmap), not the whole ISO.
+#
+# Results can be cached in a JSON file, keyed by the sha256 of the primary
+# volume descriptor (which holds the creation date of the ISO): it identifies
+# the ISO build, whatever its name or mtime. A cached ISO only costs the read
+# of its volume descriptors.
+#
+# Usage: isometa.py [--cache /path/to/cache.json] /path/to/your.iso [...]
+#        Prints "path<tab>volume id<tab>comma separated root directories"
+#        isometa.py --cache /path/to/cache.json --prune /path/to/your.iso [...]
+#        Remove the ISOs that are not given from the cache
+
+import os
+import sys
+import mmap
+import json
+import struct
+import hashlib
+import tempfile
+from os.path import basename, dirname, exists
+
+SECTOR_SIZE = 2048
+# The volume descriptors start at sector 16
+FIRST_DESCRIPTOR = 16
+PRIMARY_DESCRIPTOR = 1
+TERMINATOR = 255
+# Directories we are interested in
+KNOWN_DIRS = ['casper', 'live', 'arch', 'isolinux']
+
+
+class IsoError(Exception):
+    pass
+
+
+# Return the primary volume descriptor (2048 bytes)
+def primary_descriptor(data):
+    sector = FIRST_DESCRIPTOR
+    while (sector + 1) * SECTOR_SIZE <= len(data):
+        descriptor = data[sector * SECTOR_SIZE:(sector + 1) * SECTOR_SIZE]
+        if descriptor[1:6] != b'CD001':
+            break
+        if descriptor[0] == PRIMARY_DESCRIPTOR:
+            return descriptor
+        if descriptor[0] == TERMINATOR:
+            break
+        sector += 1
+    raise IsoError("No primary volume descriptor found")
+
+
+# Return the names in a directory extent: [[name, is_dir], ...]
+def directory_entries(data, extent, length):
+    entries = []
+    start = extent * SECTOR_SIZE
+    end = min(start + length, len(data))
+    pos = start
+    while pos < end:
+        record_len = data[pos]
+        if record_len == 0:
+            # Records do not cross sectors: continue in the next sector
+            pos = (int(pos / SECTOR_SIZE) + 1) * SECTOR_SIZE
+            continue
+        flags = data[pos + 25]
+        name_len = data[pos + 32]
+        name = bytes(data[pos + 33:pos + 33 + name_len])
+        # Skip the . and .. entries
+        if name not in (b'\x00', b'\x01'):
+            name = name.decode('ascii', 'replace').split(';')[0].rstrip('.')
+            entries.append([name, bool(flags & 2)])
+        pos += record_len
+    return entries
+
+
+# Return the metadata from the primary volume descriptor and the mapped ISO
+def read_metadata(data, pvd):
+    volume_id = pvd[40:72].decode('ascii', 'replace').strip()
+    # Root directory record at offset 156: extent and data length (little endian)
+    extent, length = struct.unpack('<I4xI', pvd[158:170])
+    entries = directory_entries(data, extent, length)
+    dirs = [name.lower() for name, is_dir in entries if is_dir]
+    return {'volume_id': volume_id,
+            'dirs': dirs,
+            'known_dirs': [d for d in KNOWN_DIRS if d in dirs],
+            'pvd_hash': hashlib.sha256(pvd).hexdigest()}
+
+
+# Call func with the mapped ISO and its primary volume descriptor
+def with_iso(path, func):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < (FIRST_DESCRIPTOR + 1) * SECTOR_SIZE:
+            raise IsoError("File too small")
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return func(data, primary_descriptor(data))
+        finally:
+            data.close()
+
+
+# Return a dictionary with the volume id and the root directories
+def read_iso(path):
+    return with_iso(path, read_metadata)
+
+
+# Metadata of several ISOs, cached in a JSON file
+class IsoMetaCache(object):
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self.entries = {}
+        self.changed = False
+        if cache_file is not None and exists(cache_file):
+            try:
+                with open(cache_file) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+
+    # Return the cached metadata or read it from the mapped ISO
+    def lookup(self, name, data, pvd):
+        key = hashlib.sha256(pvd).hexdigest()
+        meta = self.entries.get(key)
+        if meta is None:
+            meta = read_metadata(data, pvd)
+            self.entries[key] = meta
+            self.changed = True
+        if meta.get('name') != name:
+            # The name of the ISO on the device, used to prune the cache
+            meta['name'] = name
+            self.changed = True
+        return meta
+
+    # Return the metadata of an ISO or None if it is not a valid ISO
+    def get(self, path):
+        try:
+            return with_iso(path, lambda data, pvd: self.lookup(basename(path), data, pvd))
+        except (OSError, IsoError, struct.error, IndexError):
+            return None
+
+    # Only keep the ISOs with the given names
+    def prune(self, paths):
+        names = set([basename(path) for path in paths])
+        keep = dict((key, meta) for key, meta in self.entries.items() if meta.get('name') in names)
+        if keep != self.entries:
+            self.entries = keep
+            self.changed = True
+
+    # Atomically write the cache when it changed
+    def save(self):
+        if self.cache_file is None or not self.changed or not exists(dirname(self.cache_file) or '.'):
+            return
+        fd, tmp = tempfile.mkstemp(prefix='.isometa', dir=dirname(self.cache_file) or '.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.rename(tmp, self.cache_file)
+        self.changed = False
+
+
+# Return the cache file argument and the remaining arguments
+def parse_cache_argument(args):
+    if len(args) > 1 and args[0] == '--cache':
+        return args[1], args[2:]
+    return None, args
+
+
+if __name__ == '__main__':
+    cache_file, isos = parse_cache_argument(sys.argv[1:])
+    cache = IsoMetaCache(cache_file)
+    if isos and isos[0] == '--prune':
+        cache.prune(isos[1:])
+    else:
+        for iso in isos:
+            meta = cache.get(iso)
+            if meta is not None:
+                print(("{}\t{}\t{}".format(iso, meta['volume_id'], ','.join(meta['known_dirs']))))
+    cache.save()
@@ -0,0 +1,61 @@
+#! /usr/bin/env python3
+
+# Stat based ISO sizing for usb-creator
+# Sizes are returned in kB, like du -k and df --output=avail.
+# Results are memoized by path and only recalculated when the mtime or
+# size of the file changed.
+
+import os
+from os.path import join
+
+ISO_EXTENSION = '.iso'
+
+
+def size_kb(size):
+    # Round up: a partial kB still takes a kB on the device
+    return int((size + 1023) / 1024)
+
+
+class IsoSizer(object):
+    def __init__(self):
+        # path: [mtime_ns, size, kB]
+        self.cache = {}
+
+    def from_stat(self, path, st):
+        cached = self.cache.get(path)
+        if cached is not None and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            return cached[2]
+        kb = size_kb(st.st_size)
+        self.cache[path] = [st.st_mtime_ns, st.st_size, kb]
+        return kb
+
+    # Return the size of a single file (symbolic links are followed)
+    def get_size(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return 0
+        return self.from_stat(path, st)
+
+    # Return a dictionary with the sizes of all ISOs in a directory in one pass
+    # {'/path/to/your.iso': kB}
+    def scan_dir(self, directory):
+        sizes = {}
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return sizes
+        for entry in entries:
+            if entry.name.endswith(ISO_EXTENSION):
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                path = join(directory, entry.name)
+                sizes[path] = self.from_stat(path, st)
+        return sizes
+
+    def clear(self):
+        self.cache = {}
@@ -1,18 +1,108 @@
 #! /usr/bin/env python3
 
+# Logger for usb-creator
+# Messages are put on a queue and written by a background thread: the
+# caller does not wait for file I/O. All queued messages are written at
+# once with a single flush.
+# Messages for the return object (label, treeview or statusbar) are
+# collected and shown at most every UI_UPDATE_INTERVAL ms.
+# With maxSizeKB the log file is rotated by size while writing, together with
+# its session index (see logindex.py). A log file that is shared with other
+# processes must be rotated by one of them only: a log file that was moved
+# away by another process is opened again.
+
 import os
 import pwd
 import logging
 import re
-import sys
-from shutil import move
+import atexit
+import threading
+from queue import Queue, Empty
+from logging.handlers import QueueHandler
+from gi.repository import GLib
+from logindex import GENERATIONS, rotate_if_needed
 from dialogs import ErrorDialog
 from treeview import TreeViewHandler
 
+# Maximum number of records written at once
+MAX_BATCH = 512
+# Minimum time between updates of the return object in ms
+UI_UPDATE_INTERVAL = 250
+
+
+# Background thread that writes the queued records to the handlers
+class LogWriter(threading.Thread):
+    def __init__(self, queue, handlers, maxSize=None, generations=GENERATIONS):
+        super(LogWriter, self).__init__()
+        self.daemon = True
+        self.queue = queue
+        self.handlers = handlers
+        self.maxSize = maxSize
+        self.generations = generations
+
+    def run(self):
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            if None in batch:
+                # Stop after writing the records before the sentinel
+                stop = True
+                batch = batch[:batch.index(None)]
+            self.writeBatch(batch)
+            for i in range(len(batch) + (1 if stop else 0)):
+                self.queue.task_done()
+
+    # Write all records of a handler with one write and one flush
+    def writeBatch(self, batch):
+        for handler in self.handlers:
+            lines = []
+            for record in batch:
+                if record.levelno >= handler.level:
+                    try:
+                        lines.append(handler.format(record) + handler.terminator)
+                    except Exception:
+                        handler.handleError(record)
+            if lines:
+                handler.acquire()
+                try:
+                    if isinstance(handler, logging.FileHandler):
+                        self.reopenIfMoved(handler)
+                    handler.stream.write(''.join(lines))
+                    handler.stream.flush()
+                    if self.maxSize is not None and isinstance(handler, logging.FileHandler):
+                        self.rotate(handler)
+                except (OSError, ValueError):
+                    pass
+                finally:
+                    handler.release()
+
+    # Rotate the log file when it is too large and continue in a new file
+    def rotate(self, handler):
+        if rotate_if_needed(handler.baseFilename, self.maxSize, self.generations):
+            self.reopen(handler)
+
+    def reopen(self, handler):
+        old = handler.setStream(open(handler.baseFilename, 'a', encoding=handler.encoding))
+        old.close()
+
+    # Continue in the new log file when another process rotated it
+    def reopenIfMoved(self, handler):
+        try:
+            moved = os.stat(handler.baseFilename).st_ino != os.fstat(handler.stream.fileno()).st_ino
+        except FileNotFoundError:
+            moved = True
+        if moved:
+            self.reopen(handler)
+
 
 class Logger():
 
-    def __init__(self, logPath='', defaultLogLevel='debug', addLogTime=True, rtObject=None, parent=None, maxSizeKB=None):
+    def __init__(self, logPath='', defaultLogLevel='debug', addLogTime=True, rtObject=None, parent=None, maxSizeKB=None, generations=GENERATIONS):
         self.logPath = logPath
         if self.logPath != '':
             if self.logPath[:1] != '/':
@@ -24,18 +114,23 @@ class Logger():
         self.typeString = self.getTypeString(self.rtobject)
         self.parent = parent
         self.maxSizeKB = maxSizeKB
+        maxSize = None if self.maxSizeKB is None else self.maxSizeKB * 1024
+        self.tvHandler = None
+        # Messages for the return object that are not shown yet
+        self.uiMessages = []
+        self.uiLock = threading.Lock()
+        self.uiTimer = None
 
+        handlers = []
         if self.logPath == '':
             # Log only to console
-            logging.basicConfig(level=self.defaultLevel, format='%(levelname)-10s%(message)s')
+            console = logging.StreamHandler()
+            console.setLevel(self.defaultLevel)
+            console.setFormatter(logging.Formatter('%(levelname)-10s%(message)s'))
+            handlers.append(console)
         else:
-            if os.path.exists(self.logPath) and self.maxSizeKB is not None:
-                b = os.path.getsize(self.logPath)
-                if b > self.maxSizeKB * 1024:
-                    old = "%s.old" % self.logPath
-                    if os.path.exists(old):
-                        os.remove(old)
-                    move(self.logPath, "%s.old" % self.logPath)
+            if maxSize is not None:
+                rotate_if_needed(self.logPath, maxSize, generations)
             # Set basic configuration
             formatStr = '%(name)-30s%(levelname)-10s%(message)s'
             dateFmtStr = None
@@ -44,7 +139,10 @@ class Logger():
                 dateFmtStr = '%d-%m-%Y %H:%M:%S'
 
             # Log to file
-            logging.basicConfig(filename=self.logPath, level=self.defaultLevel, format=formatStr, datefmt=dateFmtStr)
+            logFile = logging.FileHandler(self.logPath)
+            logFile.setLevel(self.defaultLevel)
+            logFile.setFormatter(logging.Formatter(formatStr, dateFmtStr))
+            handlers.append(logFile)
 
             # Define a Handler which writes INFO messages or higher to the console
             # Debug messages are written to a specified log file
@@ -52,7 +150,32 @@ class Logger():
             console.setLevel(logging.INFO)
             formatter = logging.Formatter('%(levelname)-10s%(message)s')
             console.setFormatter(formatter)
-            logging.getLogger('').addHandler(console)
+            handlers.append(console)
+
+        # The loggers only queue the records: the writer thread writes them
+        self.queue = Queue()
+        self.queueHandler = QueueHandler(self.queue)
+        rootLogger = logging.getLogger('')
+        rootLogger.setLevel(self.defaultLevel)
+        rootLogger.addHandler(self.queueHandler)
+        self.handlers = handlers
+        self.writer = LogWriter(self.queue, handlers, maxSize, generations)
+        self.writer.start()
+        atexit.register(self.close)
+
+    # Wait until all queued messages are written
+    def flush(self):
+        if self.writer.is_alive():
+            self.queue.join()
+
+    # Write the queued messages and stop the writer thread
+    def close(self):
+        if self.writer.is_alive():
+            logging.getLogger('').removeHandler(self.queueHandler)
+            self.queue.put(None)
+            self.writer.join()
+            for handler in self.handlers:
+                handler.close()
 
     # Write message
     def write(self, message, loggerName='log', logLevel='debug', showErrorDialog=True):
@@ -83,22 +206,36 @@ class Logger():
                 self.rtobjectWrite(message)
                 if showErrorDialog:
                     ErrorDialog('Exception', message)
-            # Flush now
-            sys.stdout.flush()
 
     # Return messge to given object
+    # The messages are collected and shown on the main loop
     def rtobjectWrite(self, message):
         if self.rtobject is not None and self.typeString != '':
+            with self.uiLock:
+                self.uiMessages.append(message)
+                if self.uiTimer is None:
+                    self.uiTimer = GLib.timeout_add(UI_UPDATE_INTERVAL, self.rtobjectUpdate)
+
+    # Show the collected messages in one update
+    def rtobjectUpdate(self):
+        with self.uiLock:
+            messages = self.uiMessages
+            self.uiMessages = []
+            self.uiTimer = None
+        if messages:
             if 'label' in self.typeString.lower():
-                self.rtobject.set_text(message)
+                self.rtobject.set_text(messages[-1])
             elif 'treeview' in self.typeString.lower():
-                tvHandler = TreeViewHandler(self.rtobject)
-                tvHandler.fillTreeview([message], ['str'], [-1], 0, 400, False, True, True, fontSize=10000)
+                if self.tvHandler is None:
+                    self.tvHandler = TreeViewHandler(self.rtobject)
+                self.tvHandler.fillTreeview(messages, ['str'], -1, 400, False, True, True, fontSize=10000)
             elif 'statusbar' in self.typeString.lower():
-                self.pushMessage(message)
+                self.pushMessage(messages[-1])
             else:
                 # For obvious reasons: do not log this...
                 print(('Return object type not implemented: %s' % self.typeString))
+        # Do not repeat
+        return False
 
     # Return the type string of a object
     def getTypeString(self, object):
@@ -0,0 +1,164 @@
+#! /usr/bin/env python3
+
+# Session index of the usb-creator log
+# Next to the log (e.g. /var/log/usb-creator.log.idx) one JSON object per
+# line records where a session or a stage starts in the log:
+#   {"type": "session", "offset": 81920, "time": 1760000000.5, "pid": 1234,
+#    "command": "-d /dev/sdb -b -g"}
+#   {"type": "stage", "offset": 82417, "uptime": 1201.35, "name": "copy",
+#    "item": "solydx.iso"}
+# offset is the size of the log in bytes when the session or stage started:
+# readers seek to it instead of scanning the log.
+# The log and its index are rotated together by size: log.1 is the newest
+# generation, log.GENERATIONS the oldest.
+#
+# Usage:
+#   logindex.py start /var/log/usb-creator.log [command ...]
+#       Rotate the log when it is too large and start a new session
+#   logindex.py list /var/log/usb-creator.log
+#       Print "offset<tab>type<tab>name<tab>item" for all entries
+#   logindex.py show /var/log/usb-creator.log [session]
+#       Print a session of the log (default: the last one, -1)
+
+import os
+import sys
+import json
+import time
+from os.path import exists, getsize
+
+INDEX_SUFFIX = '.idx'
+MAX_SIZE = 5120 * 1024
+GENERATIONS = 3
+SESSION_BANNER = ("===========================================================\n"
+                  "===============>>>>> Log session start <<<<<===============\n"
+                  "===========================================================\n")
+
+
+def index_path(log):
+    return log + INDEX_SUFFIX
+
+
+def log_size(log):
+    try:
+        return getsize(log)
+    except OSError:
+        return 0
+
+
+# Move the log and its index one generation up and drop the oldest
+def rotate_log(log, generations=GENERATIONS):
+    for path in (log, index_path(log)):
+        for i in range(generations - 1, 0, -1):
+            source = "{}.{}".format(path, i)
+            if exists(source):
+                os.replace(source, "{}.{}".format(path, i + 1))
+        if generations > 0 and exists(path):
+            os.replace(path, "{}.1".format(path))
+        elif exists(path):
+            os.remove(path)
+
+
+# Rotate the log when it is larger than max_size bytes
+# Return True when it was rotated
+def rotate_if_needed(log, max_size=MAX_SIZE, generations=GENERATIONS):
+    if log_size(log) > max_size:
+        rotate_log(log, generations)
+        return True
+    return False
+
+
+# Append an entry to the index with the current size of the log as offset
+def add_entry(log, entry):
+    entry = dict(entry)
+    entry['offset'] = log_size(log)
+    with open(index_path(log), 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    return entry
+
+
+# Rotate the log if needed, write the session banner and index it
+def start_session(log, command='', max_size=MAX_SIZE, generations=GENERATIONS):
+    rotate_if_needed(log, max_size, generations)
+    entry = add_entry(log, {'type': 'session', 'time': round(time.time(), 2),
+                            'pid': os.getppid(), 'command': command})
+    with open(log, 'a') as f:
+        f.write(SESSION_BANNER)
+    return entry
+
+
+# Return the entries of the index
+# Entries beyond the end of the log (e.g. after it was truncated) are skipped
+def read_index(log):
+    entries = []
+    size = log_size(log)
+    try:
+        with open(index_path(log)) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(entry, dict) and isinstance(entry.get('offset'), int) \
+                        and 0 <= entry['offset'] <= size:
+                    entries.append(entry)
+    except OSError:
+        pass
+    return entries
+
+
+# Return [start, end] offsets of a session (end is None for the last one)
+# session is the index in the list of sessions, -1 is the last one
+def session_range(log, session=-1, entries=None):
+    if entries is None:
+        entries = read_index(log)
+    starts = [e['offset'] for e in entries if e.get('type') == 'session']
+    try:
+        start = starts[session]
+    except IndexError:
+        return None
+    position = starts.index(start)
+    end = starts[position + 1] if position + 1 < len(starts) else None
+    return [start, end]
+
+
+# Return the entries of the stages of a session
+def session_stages(log, session=-1, entries=None):
+    if entries is None:
+        entries = read_index(log)
+    bounds = session_range(log, session, entries)
+    if bounds is None:
+        return []
+    start, end = bounds
+    return [e for e in entries if e.get('type') == 'stage' and e['offset'] >= start
+            and (end is None or e['offset'] < end)]
+
+
+# Return the text of a session without reading the log before it
+def read_session(log, session=-1):
+    bounds = session_range(log, session)
+    if bounds is None:
+        return ''
+    start, end = bounds
+    with open(log, 'rb') as f:
+        f.seek(start)
+        data = f.read() if end is None else f.read(end - start)
+    return data.decode('utf-8', 'replace')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('start', 'list', 'show'):
+        sys.stderr.write("Usage: logindex.py start /path/to/log [command ...]\n"
+                         "       logindex.py list /path/to/log\n"
+                         "       logindex.py show /path/to/log [session]\n")
+        sys.exit(2)
+    log = sys.argv[2]
+    if sys.argv[1] == 'start':
+        start_session(log, ' '.join(sys.argv[3:]))
+        sys.stdout.write(SESSION_BANNER)
+    elif sys.argv[1] == 'list':
+        for entry in read_index(log):
+            print(("{}\t{}\t{}\t{}".format(entry['offset'], entry.get('type', '-'),
+                                           entry.get('name', '-'), entry.get('item', '') or '-')))
+    else:
+        session = int(sys.argv[3]) if len(sys.argv) > 3 else -1
+        sys.stdout.write(read_session(log, session))
@@ -0,0 +1,123 @@
+#! /usr/bin/env python3
+
+# Structured progress channel between the usb-creator backend and the GUI
+# The GUI creates a pipe and passes the write end to usb-creator in the
+# USBCREATOR_PROGRESS_FD environment variable. The backend writes one JSON
+# object per line:
+#   {"stage": "copy", "item": "solydx.iso", "done": 1048576, "total": 2097152,
+#    "rate": 31.5, "eta": 12}
+# done and total are in bytes, rate in MB/s and eta in seconds.
+# Stages without done/total (e.g. "partition") only report that they started.
+#
+# When a step is done, a timing record is sent (and written to the log):
+#   {"stage": "timing", "item": "solydx.iso", "name": "copy", "start": 1201.35,
+#    "end": 1265.82, "seconds": 64.47, "bytes": 2097152, "rate": 31.0}
+# start and end are monotonic times in seconds.
+
+import os
+import json
+import time
+
+PROGRESS_FD_ENV = 'USBCREATOR_PROGRESS_FD'
+TIMING_STAGE = 'timing'
+# Minimum seconds between two events of the same stage
+EVENT_INTERVAL = 0.5
+# Seconds in which the ETA moves from the expected rate to the measured rate:
+# the first writes go to the page cache and look much faster than the device
+RATE_WARMUP = 5.0
+
+
+# Open the progress pipe that was passed by the GUI
+def open_progress_stream():
+    fd = os.environ.get(PROGRESS_FD_ENV, '')
+    if fd.isdigit():
+        try:
+            return os.fdopen(int(fd), 'w', buffering=1, closefd=False)
+        except OSError:
+            pass
+    return None
+
+
+class ProgressWriter(object):
+    def __init__(self, stage, item='', stream=None, interval=EVENT_INTERVAL, expected_rate=0):
+        self.stage = stage
+        self.item = item
+        self.stream = stream if stream is not None else open_progress_stream()
+        self.interval = interval
+        # MB/s from the profile of the device (see stickprofile.py), 0 when unknown
+        self.expected_rate = expected_rate
+        self.start = time.monotonic()
+        self.last = 0
+
+    # Use as progress callback: called with (bytes_done, bytes_total)
+    def __call__(self, done, total):
+        now = time.monotonic()
+        if done < total and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = now - self.start
+        rate = done / elapsed / 1048576 if elapsed > 0 else 0
+        eta_rate = rate
+        if self.expected_rate > 0 and elapsed < RATE_WARMUP:
+            weight = elapsed / RATE_WARMUP
+            eta_rate = weight * rate + (1 - weight) * self.expected_rate
+        eta = int((total - done) / (eta_rate * 1048576)) if eta_rate > 0 else -1
+        self.emit(done=done, total=total, rate=round(rate, 1), eta=eta)
+
+    def emit(self, **values):
+        if self.stream is None:
+            return
+        event = {'stage': self.stage, 'item': self.item}
+        event.update(values)
+        try:
+            self.stream.write(json.dumps(event) + '\n')
+        except (OSError, ValueError):
+            # The GUI is gone: stop reporting
+            self.stream = None
+
+
+# Read progress events from the read end of the pipe without blocking
+class ProgressReader(object):
+    def __init__(self, fd):
+        self.fd = fd
+        self.buffer = b''
+        os.set_blocking(fd, False)
+
+    def fileno(self):
+        return self.fd
+
+    # Return the list of complete events that are available
+    def read_events(self):
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            self.buffer += data
+        lines = self.buffer.split(b'\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            try:
+                event = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            if isinstance(event, dict) and 'stage' in event:
+                events.append(event)
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Return the timing records added up per name, longest first:
+# [[name, seconds, bytes], ...]
+def timing_summary(records):
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record.get('name', ''), [record.get('name', ''), 0, 0])
+        total[1] += record.get('seconds', 0)
+        total[2] += record.get('bytes', 0)
+    return sorted(totals.values(), key=lambda total: total[1], reverse=True)
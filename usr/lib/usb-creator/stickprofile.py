@@ -0,0 +1,284 @@
+#! /usr/bin/env python3
+
+# Profiles of USB sticks for usb-creator
+# The profiler measures the sequential write and read speed and the latency
+# of small synced writes of a device in a few seconds, with a temporary file
+# on its mounted partition. The profile is saved in a database keyed by the
+# USB vendor, product and serial of the stick, with its history: number of
+# sessions and failures, bytes written and the bad regions found by a
+# surface scan (see surfacescan.py):
+#   {"0781:5567:4C530001": {"model": "SanDisk Cruzer Blade", "size": 16008609792,
+#     "profile": {"write": 12.5, "read": 31.0, "latency": 4.2, "time": 1760000000},
+#     "history": {"sessions": 3, "failures": 1, "bytes": 4294967296, "last_exit": 0,
+#                 "last": 1760000000, "bad_regions": [[start, end], ...],
+#                 "aliased": 0, "usable": 16008609792, "scanned": 1760000000}}}
+# The copy engine, the fan-out copy and the ETA use the profile to pick the
+# buffer size, the queue depth and the expected rate.
+#
+# Usage:
+#   stickprofile.py settings DATABASE /dev/device [/mount/point]
+#       Print "buffer size<tab>queue depth<tab>expected MB/s<tab>poll seconds"
+#       With a mount point, the device is profiled when it has no current profile
+#   stickprofile.py profile DATABASE /dev/device /mount/point
+#       Profile the device and print "write MB/s<tab>read MB/s<tab>latency ms"
+#   stickprofile.py record DATABASE /dev/device exit_code [bytes written]
+#       Add a session to the history of the device
+
+import os
+import sys
+import json
+import time
+import fcntl
+import tempfile
+from os.path import abspath, basename, dirname, exists, join, realpath
+from copyengine import BUFFER_SIZE, aligned_buffer, drop_cache, write_all_at
+from fanout import QUEUE_DEPTH
+from sysdevices import SYS_ROOT, get_device_info, get_usb_ids
+
+PROFILE_FILE = '.usb-creator-profile'
+# Profile at most PROFILE_SIZE bytes or PROFILE_SECONDS seconds
+PROFILE_SIZE = 64 * 1024 * 1024
+PROFILE_SECONDS = 2.0
+PROFILE_BUFFER_SIZE = 4 * 1024 * 1024
+# Small synced writes to measure the latency
+SMALL_WRITE_SIZE = 4096
+SMALL_WRITES = 16
+# Profiles older than this are measured again
+PROFILE_AGE = 30 * 24 * 3600
+# A copy buffer holds about BUFFER_SECONDS of writing
+BUFFER_SECONDS = 0.25
+MIN_BUFFER_SIZE = 1024 * 1024
+MAX_BUFFER_SIZE = 16 * 1024 * 1024
+# Sticks with slow small writes get large buffers
+SLOW_LATENCY = 20.0
+# A fan-out writer may lag QUEUE_SECONDS of writing behind
+QUEUE_SECONDS = 4.0
+MIN_QUEUE_DEPTH = 4
+MAX_QUEUE_DEPTH = 64
+# Maximum number of bad regions kept in the history
+MAX_BAD_REGIONS = 64
+
+
+# Return the database key and the model of a device
+# Devices that are not connected through USB are keyed by their path
+def device_key(device, sys_root=SYS_ROOT):
+    ids = get_usb_ids(device, sys_root)
+    if ids is None:
+        return ["path:{}".format(realpath(device)), '']
+    model = ' '.join([ids['manufacturer'], ids['model']]).strip()
+    return ["{}:{}:{}".format(ids['vendor'], ids['product'], ids['serial']), model]
+
+
+class StickDatabase(object):
+    def __init__(self, db_file):
+        self.db_file = abspath(db_file)
+        self.lock_file = "{}.lock".format(self.db_file)
+        self.lock_fd = None
+        self.sticks = {}
+
+    # Hold an exclusive lock while reading and writing:
+    # several usb-creator processes write to several sticks at once
+    def __enter__(self):
+        self.lock_fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        self.set_owner(self.lock_file)
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        self.load()
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+        os.close(self.lock_fd)
+        self.lock_fd = None
+
+    def load(self):
+        self.sticks = {}
+        if exists(self.db_file):
+            try:
+                with open(self.db_file) as f:
+                    sticks = json.load(f)
+                if isinstance(sticks, dict):
+                    self.sticks = sticks
+            except (OSError, ValueError):
+                # Corrupt database: start over
+                self.sticks = {}
+
+    # Atomically replace the database file
+    def save(self):
+        fd, tmp = tempfile.mkstemp(prefix='.sticks', dir=dirname(self.db_file))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.sticks, f, indent=1, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp, 0o644)
+            self.set_owner(tmp)
+            os.rename(tmp, self.db_file)
+        except:
+            if exists(tmp):
+                os.remove(tmp)
+            raise
+
+    # usb-creator runs as root: keep the database owned by the user
+    def set_owner(self, path):
+        if os.geteuid() == 0:
+            st = os.stat(dirname(self.db_file))
+            os.chown(path, st.st_uid, st.st_gid)
+
+    # Return the entry of a device, create it when it does not exist
+    def stick(self, device, sys_root=SYS_ROOT):
+        key, model = device_key(device, sys_root)
+        entry = self.sticks.setdefault(key, {'profile': None, 'history': {}})
+        if model:
+            entry['model'] = model
+        size = get_device_info(device, sys_root)['size']
+        if size:
+            entry['size'] = size
+        return entry
+
+
+# Return the profile of a device or None
+def get_profile(db_file, device):
+    with StickDatabase(db_file) as db:
+        return db.stick(device)['profile']
+
+
+# Measure the device with a temporary file on its mounted partition
+# Return {'write': MB/s, 'read': MB/s, 'latency': ms, 'time': seconds since epoch}
+def profile_mount(mount, size=PROFILE_SIZE, seconds=PROFILE_SECONDS):
+    path = join(mount, PROFILE_FILE)
+    buf = aligned_buffer(PROFILE_BUFFER_SIZE)
+    buf[0:PROFILE_BUFFER_SIZE] = os.urandom(PROFILE_BUFFER_SIZE)
+    view = memoryview(buf)
+    flags = os.O_RDWR | os.O_CREAT | os.O_TRUNC
+    try:
+        fd = os.open(path, flags | os.O_DIRECT, 0o644)
+        direct = True
+    except (AttributeError, OSError):
+        fd = os.open(path, flags, 0o644)
+        direct = False
+    try:
+        # Sequential write, synced
+        start = time.monotonic()
+        written = 0
+        while written < size and time.monotonic() - start < seconds:
+            written += write_all_at(fd, view, written)
+        os.fdatasync(fd)
+        write_seconds = time.monotonic() - start
+
+        # Sequential read from the device, not from the page cache
+        if not direct:
+            drop_cache(fd)
+        start = time.monotonic()
+        done = 0
+        while done < written:
+            n = os.preadv(fd, [buf], done)
+            if n == 0:
+                break
+            done += n
+        read_seconds = time.monotonic() - start
+
+        # Small synced writes
+        latencies = []
+        small = view[:SMALL_WRITE_SIZE]
+        for i in range(SMALL_WRITES):
+            offset = (i * 7919 * SMALL_WRITE_SIZE) % max(SMALL_WRITE_SIZE, written)
+            start = time.monotonic()
+            write_all_at(fd, small, offset)
+            os.fdatasync(fd)
+            latencies.append(time.monotonic() - start)
+    finally:
+        os.close(fd)
+        os.remove(path)
+    latencies.sort()
+    mb = 1048576
+    return {'write': round(written / write_seconds / mb, 1) if write_seconds > 0 else 0,
+            'read': round(done / read_seconds / mb, 1) if read_seconds > 0 else 0,
+            'latency': round(latencies[int(len(latencies) / 2)] * 1000, 2),
+            'time': int(time.time())}
+
+
+# Profile a device and save the profile
+def profile_device(db_file, device, mount):
+    profile = profile_mount(mount)
+    with StickDatabase(db_file) as db:
+        db.stick(device)['profile'] = profile
+        db.save()
+    return profile
+
+
+# True when the profile is missing or too old
+def needs_profile(profile):
+    return profile is None or time.time() - profile.get('time', 0) > PROFILE_AGE
+
+
+# Return [buffer size, queue depth, expected MB/s, poll seconds] for a profile
+def pick_settings(profile):
+    if not profile or profile.get('write', 0) <= 0:
+        return [BUFFER_SIZE, QUEUE_DEPTH, 0, 5]
+    rate = profile['write'] * 1048576
+    buffer_size = MIN_BUFFER_SIZE
+    while buffer_size * 2 <= rate * BUFFER_SECONDS and buffer_size < MAX_BUFFER_SIZE:
+        buffer_size *= 2
+    if profile.get('latency', 0) > SLOW_LATENCY:
+        # Few large writes: the stick pays for every write it receives
+        buffer_size = max(buffer_size, MAX_BUFFER_SIZE / 2)
+    queue_depth = int(rate * QUEUE_SECONDS / buffer_size)
+    queue_depth = max(MIN_QUEUE_DEPTH, min(MAX_QUEUE_DEPTH, queue_depth))
+    # Fast sticks are done soon: check more often
+    poll = 1 if profile['write'] >= 20 else 5
+    return [int(buffer_size), queue_depth, profile['write'], poll]
+
+
+# Add a session to the history of a device
+def record_session(db_file, device, exit_code, written=0):
+    with StickDatabase(db_file) as db:
+        history = db.stick(device)['history']
+        history['sessions'] = history.get('sessions', 0) + 1
+        if exit_code != 0:
+            history['failures'] = history.get('failures', 0) + 1
+        history['bytes'] = history.get('bytes', 0) + written
+        history['last_exit'] = exit_code
+        history['last'] = int(time.time())
+        db.save()
+
+
+# Save the bad regions and the usable size found by a surface scan
+def record_scan(db_file, device, bad_regions, usable, aliased=0):
+    with StickDatabase(db_file) as db:
+        history = db.stick(device)['history']
+        history['bad_regions'] = bad_regions[:MAX_BAD_REGIONS]
+        history['aliased'] = aliased
+        history['usable'] = usable
+        history['scanned'] = int(time.time())
+        db.save()
+
+
+def usage():
+    sys.stderr.write("Usage: {0} settings DATABASE DEVICE [MOUNT]\n"
+                     "       {0} profile DATABASE DEVICE MOUNT\n"
+                     "       {0} record DATABASE DEVICE EXIT_CODE [BYTES]\n".format(basename(sys.argv[0])))
+    sys.exit(2)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        usage()
+    action, db_file, device = sys.argv[1:4]
+    if action == 'settings' and len(sys.argv) in (4, 5):
+        profile = get_profile(db_file, device)
+        if len(sys.argv) == 5 and needs_profile(profile):
+            try:
+                profile = profile_device(db_file, device, sys.argv[4])
+                sys.stderr.write("Profile of {}: write {} MB/s, read {} MB/s, latency {} ms\n".format(
+                    device, profile['write'], profile['read'], profile['latency']))
+            except OSError as detail:
+                sys.stderr.write("Cannot profile {}: {}\n".format(device, detail))
+        print(("\t".join([str(value) for value in pick_settings(profile)])))
+    elif action == 'profile' and len(sys.argv) == 5:
+        profile = profile_device(db_file, device, sys.argv[4])
+        print(("{}\t{}\t{}".format(profile['write'], profile['read'], profile['latency'])))
+    elif action == 'record' and len(sys.argv) in (5, 6) and sys.argv[4].isdigit():
+        written = int(sys.argv[5]) if len(sys.argv) == 6 and sys.argv[5].isdigit() else 0
+        record_session(db_file, device, int(sys.argv[4]), written)
+    else:
+        usage()
@@ -0,0 +1,289 @@
+#! /usr/bin/env python3
+
+# Surface scan for usb-creator
+# Writes a unique pattern to blocks of the device and reads them back.
+# It finds blocks that cannot be written or read or that return other data
+# (bad blocks). It also finds counterfeit sticks that report more capacity
+# than they have: their blocks beyond the real capacity are lost or wrap
+# around to other blocks (aliased).
+# All data on the device is lost.
+#
+# Modes:
+#   quick   SAMPLES blocks spread over the whole device
+#   stride  every STRIDE-th block
+#   full    every block
+# All blocks are written before the first block is read back: on a
+# counterfeit stick the later writes overwrite the earlier blocks.
+# Every sector of a block starts with the scan id and the sector number,
+# so a block that is read back tells where it was written.
+#
+# Usage: surfacescan.py [--mode quick|stride|full]
+#                       [--badblocks FILE --partition-start BYTES]
+#                       [--profile-db DATABASE] /dev/device
+# Prints "size<tab>usable size<tab>scanned<tab>bad blocks<tab>aliased blocks"
+# (size, usable size and scanned in bytes). The bad and aliased regions and
+# the throughput per region are printed to stderr.
+# --badblocks writes the bad blocks in the partition that starts at the
+# given byte as 1 KiB block numbers, as read by mkfs.vfat -l.
+# --profile-db saves the bad regions and the usable size in the history of
+# the stick (see stickprofile.py).
+
+import os
+import sys
+import stat
+import time
+import random
+import struct
+from os.path import basename
+from copyengine import aligned_buffer, device_size, drop_cache, write_all_at
+from progress import ProgressWriter
+from stickprofile import record_scan
+
+MODES = ['quick', 'stride', 'full']
+BLOCK_SIZE = 1024 * 1024
+SECTOR_SIZE = 512
+# Blocks written in quick mode
+SAMPLES = 256
+# Every n-th block is written in stride mode
+STRIDE = 16
+# The device is split in regions to report the throughput
+REGIONS = 8
+# Failing blocks at the end of the device: the capacity is fake
+MIN_FAKE_BLOCKS = 2
+# Scan id and sector number at the start of every sector
+HEADER = struct.Struct('<8sQ')
+
+
+# Return the indexes of the blocks to scan
+def scan_blocks(size, mode, scan_id):
+    blocks = int(size / BLOCK_SIZE)
+    if blocks == 0:
+        return []
+    if mode == 'full':
+        return list(range(blocks))
+    if mode == 'stride':
+        indexes = set(range(0, blocks, STRIDE))
+    else:
+        # Evenly spread, at a random place in every step
+        # Never more blocks than in stride mode
+        count = max(1, min(SAMPLES, int(blocks / STRIDE)))
+        rnd = random.Random(scan_id)
+        step = blocks / count
+        indexes = set([min(blocks - 1, int(i * step + rnd.random() * step)) for i in range(count)])
+    # Always test the last block: that is where counterfeit sticks fail
+    indexes.add(blocks - 1)
+    return sorted(indexes)
+
+
+# Fill a buffer with the pattern of the block at offset
+def fill_pattern(buf, filler, scan_id, offset):
+    buf[0:BLOCK_SIZE] = filler
+    first = int(offset / SECTOR_SIZE)
+    for i in range(int(BLOCK_SIZE / SECTOR_SIZE)):
+        HEADER.pack_into(buf, i * SECTOR_SIZE, scan_id, first + i)
+
+
+# Open the device with O_DIRECT if possible: return [fd, direct]
+def open_device(path, flags):
+    if hasattr(os, 'O_DIRECT'):
+        try:
+            return [os.open(path, flags | os.O_DIRECT), True]
+        except OSError:
+            pass
+    return [os.open(path, flags), False]
+
+
+# Return the size of a device or file
+def scan_size(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = device_size(fd)
+        return os.fstat(fd).st_size if size is None else size
+    finally:
+        os.close(fd)
+
+
+# Return the size that can be used: the blocks at the end that all failed
+# are beyond the real capacity
+# A stick that wraps around writes the blocks beyond its real capacity over
+# its first blocks: those read back the data of a block beyond the capacity,
+# while the blocks at the end read back fine. An aliased block is a multiple
+# of the real capacity away from the block it returned: the shortest
+# distance is the real capacity.
+def usable_size(size, offsets, failed):
+    usable = size
+    tail = len(offsets)
+    while tail > 0 and offsets[tail - 1] in failed:
+        tail -= 1
+    if len(offsets) - tail >= MIN_FAKE_BLOCKS:
+        usable = offsets[tail - 1] + BLOCK_SIZE if tail > 0 else 0
+    distances = [abs(source - offset) for offset, source in failed.items() if source is not None]
+    if distances:
+        usable = min(usable, int(min(distances) / BLOCK_SIZE) * BLOCK_SIZE)
+    return usable
+
+
+# Write and read back the blocks of the device
+# progress is called with (bytes_done, bytes_total) for the writes and reads
+# Return a dict with:
+#   size, usable (bytes), scanned (bytes),
+#   bad: [offset, ...], aliased: [[offset, offset it returned], ...],
+#   regions: [[start, end, write MB/s, read MB/s], ...]
+def scan_device(path, mode='quick', progress=None):
+    scan_id = os.urandom(8)
+    size = scan_size(path)
+    offsets = [block * BLOCK_SIZE for block in scan_blocks(size, mode, scan_id)]
+    total = 2 * len(offsets) * BLOCK_SIZE
+    region_size = max(1, size / REGIONS)
+    # Per region: [bytes written, seconds, bytes read, seconds]
+    regions = [[0, 0.0, 0, 0.0] for i in range(REGIONS)]
+    filler = os.urandom(BLOCK_SIZE)
+    buf = aligned_buffer(BLOCK_SIZE)
+    view = memoryview(buf)
+    expected = aligned_buffer(BLOCK_SIZE)
+    failed = {}
+    done = 0
+
+    flags = os.O_WRONLY
+    if stat.S_ISBLK(os.stat(path).st_mode):
+        # Fails when the device is mounted
+        flags |= os.O_EXCL
+    fd, direct = open_device(path, flags)
+    try:
+        for offset in offsets:
+            fill_pattern(buf, filler, scan_id, offset)
+            start = time.monotonic()
+            try:
+                write_all_at(fd, view, offset)
+            except OSError:
+                failed[offset] = None
+            region = regions[min(REGIONS - 1, int(offset / region_size))]
+            region[0] += BLOCK_SIZE
+            region[1] += time.monotonic() - start
+            done += BLOCK_SIZE
+            if progress is not None:
+                progress(done, total)
+        os.fsync(fd)
+        if not direct:
+            drop_cache(fd)
+    finally:
+        os.close(fd)
+
+    fd, direct = open_device(path, os.O_RDONLY)
+    try:
+        if not direct:
+            drop_cache(fd)
+        for offset in offsets:
+            start = time.monotonic()
+            try:
+                n = os.preadv(fd, [buf], offset)
+            except OSError:
+                n = 0
+            region = regions[min(REGIONS - 1, int(offset / region_size))]
+            region[2] += BLOCK_SIZE
+            region[3] += time.monotonic() - start
+            if not direct:
+                drop_cache(fd, offset, BLOCK_SIZE)
+            if offset not in failed:
+                fill_pattern(expected, filler, scan_id, offset)
+                if n < BLOCK_SIZE:
+                    failed[offset] = None
+                # Slicing the mmap compares much faster than a memoryview
+                elif buf[0:BLOCK_SIZE] != expected[0:BLOCK_SIZE]:
+                    found_id, sector = HEADER.unpack_from(buf, 0)
+                    source = sector * SECTOR_SIZE
+                    # Data of another block of this scan: the block is aliased
+                    failed[offset] = source if found_id == scan_id and source != offset else None
+            done += BLOCK_SIZE
+            if progress is not None:
+                progress(done, total)
+    finally:
+        os.close(fd)
+
+    usable = usable_size(size, offsets, failed)
+    report_regions = []
+    for i, region in enumerate(regions):
+        write_rate = region[0] / region[1] / 1048576 if region[1] > 0 else 0
+        read_rate = region[2] / region[3] / 1048576 if region[3] > 0 else 0
+        report_regions.append([int(i * region_size), int(min(size, (i + 1) * region_size)),
+                               round(write_rate, 1), round(read_rate, 1)])
+    return {'size': size,
+            'usable': usable,
+            'scanned': len(offsets) * BLOCK_SIZE,
+            'bad': sorted([offset for offset, source in failed.items() if source is None]),
+            'aliased': sorted([[offset, source] for offset, source in failed.items() if source is not None]),
+            'regions': report_regions}
+
+
+# Merge block offsets to ranges: [[start, end], ...]
+def block_ranges(offsets):
+    ranges = []
+    for offset in sorted(offsets):
+        if ranges and ranges[-1][1] == offset:
+            ranges[-1][1] = offset + BLOCK_SIZE
+        else:
+            ranges.append([offset, offset + BLOCK_SIZE])
+    return ranges
+
+
+# Return the 1 KiB blocks of the partition that are bad, aliased or beyond its end
+def partition_bad_blocks(result, partition_start):
+    blocks = []
+    for offset in sorted(result['bad'] + [offset for offset, source in result['aliased']]):
+        if offset + BLOCK_SIZE <= partition_start or offset >= result['usable']:
+            continue
+        first = max(offset, partition_start)
+        blocks.extend(range(int((first - partition_start) / 1024),
+                            int((offset + BLOCK_SIZE - partition_start) / 1024)))
+    return blocks
+
+
+# Print what was found
+def print_report(path, mode, result, stream=sys.stderr):
+    mb = 1048576
+    stream.write("Surface scan of {} ({}): {} MB of {} MB scanned, {} bad blocks, {} aliased blocks\n".format(
+        path, mode, int(result['scanned'] / mb), int(result['size'] / mb), len(result['bad']), len(result['aliased'])))
+    for start, end, write_rate, read_rate in result['regions']:
+        stream.write("  Region {}-{} MB: write {} MB/s, read {} MB/s\n".format(int(start / mb), int(end / mb),
+                                                                              write_rate, read_rate))
+    for start, end in block_ranges(result['bad']):
+        stream.write("  Bad: {}-{} MB\n".format(int(start / mb), int(end / mb)))
+    for offset, source in result['aliased'][:10]:
+        stream.write("  Aliased: {} MB returns the data of {} MB\n".format(int(offset / mb), int(source / mb)))
+    if result['usable'] < result['size']:
+        stream.write("{} reports {} MB but only {} MB can be used\n".format(path, int(result['size'] / mb),
+                                                                          int(result['usable'] / mb)))
+
+
+def usage():
+    sys.stderr.write("Usage: {} [--mode quick|stride|full] [--badblocks FILE --partition-start BYTES] "
+                     "[--profile-db DATABASE] device\n".format(basename(sys.argv[0])))
+    sys.exit(2)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    options = {'--mode': 'quick', '--badblocks': None, '--partition-start': '0', '--profile-db': None}
+    while len(args) > 1 and args[0] in options:
+        options[args[0]] = args[1]
+        args = args[2:]
+    if len(args) != 1 or options['--mode'] not in MODES or not options['--partition-start'].isdigit():
+        usage()
+    device = args[0]
+    mode = options['--mode']
+    result = scan_device(device, mode, ProgressWriter('badblocks', basename(device)))
+    print_report(device, mode, result)
+    if options['--badblocks'] is not None:
+        with open(options['--badblocks'], 'w') as f:
+            for block in partition_bad_blocks(result, int(options['--partition-start'])):
+                f.write("{}\n".format(block))
+    if options['--profile-db'] is not None:
+        # Aliased blocks cannot be trusted either
+        bad = result['bad'] + [offset for offset, source in result['aliased']]
+        try:
+            record_scan(options['--profile-db'], device, block_ranges(bad), result['usable'],
+                        len(result['aliased']))
+        except OSError as detail:
+            sys.stderr.write("Cannot save the scan of {}: {}\n".format(device, detail))
+    print(("{}\t{}\t{}\t{}\t{}".format(result['size'], result['usable'], result['scanned'],
+                                       len(result['bad']), len(result['aliased']))))
@@ -0,0 +1,147 @@
+#! /usr/bin/env python3
+
+# Device discovery for usb-creator
+# Reads removable, size and partition information straight from sysfs and
+# listens to kernel uevents to keep the device list up to date.
+# All functions take a sys_root argument so they can be run against a fake
+# sysfs tree, e.g.:
+#   /tmp/fakesys/block/sdb/removable      1
+#   /tmp/fakesys/block/sdb/size           15633408
+#   /tmp/fakesys/block/sdb/sdb1/partition 1
+
+import os
+import re
+import socket
+from os.path import basename, dirname, exists, isdir, join, realpath
+
+SYS_ROOT = '/sys'
+# Size in sysfs is always in 512 byte sectors
+SECTOR_SIZE = 512
+# Same devices as udisks --enumerate-device-files | egrep '/dev/sd[a-z]$'
+DEVICE_PATTERN = re.compile(r'^sd[a-z]$')
+# See linux/netlink.h
+NETLINK_KOBJECT_UEVENT = 15
+
+
+def read_sys_value(path, default=''):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (OSError, IOError):
+        return default
+
+
+def read_sys_int(path, default=0):
+    try:
+        return int(read_sys_value(path))
+    except ValueError:
+        return default
+
+
+# Return the partition names of a disk, e.g.: ['sdb1', 'sdb2']
+def get_partitions(name, sys_root=SYS_ROOT):
+    partitions = []
+    disk_dir = join(sys_root, 'block', name)
+    if isdir(disk_dir):
+        for entry in sorted(os.listdir(disk_dir)):
+            if entry.startswith(name) and exists(join(disk_dir, entry, 'partition')):
+                partitions.append(entry)
+    return partitions
+
+
+# A disk is detachable when it is removable or connected through USB
+def is_detachable(name, sys_root=SYS_ROOT):
+    disk_dir = join(sys_root, 'block', name)
+    if read_sys_int(join(disk_dir, 'removable')) == 1:
+        return True
+    return '/usb' in realpath(disk_dir)
+
+
+# Return a dictionary with the information of a disk
+def get_device_info(name, sys_root=SYS_ROOT):
+    name = basename(name)
+    disk_dir = join(sys_root, 'block', name)
+    partitions = get_partitions(name, sys_root)
+    return {'path': join('/dev', name),
+            'name': name,
+            'size': read_sys_int(join(disk_dir, 'size')) * SECTOR_SIZE,
+            'detachable': is_detachable(name, sys_root),
+            'partitions': partitions,
+            'has_partition': len(partitions) > 0}
+
+
+# Return the USB ids of a disk: {'vendor': '0781', 'product': '5567',
+# 'serial': '4C530001', 'manufacturer': 'SanDisk', 'model': 'Cruzer Blade'}
+# or None when the disk is not connected through USB
+def get_usb_ids(name, sys_root=SYS_ROOT):
+    name = basename(name)
+    path = realpath(join(sys_root, 'block', name, 'device'))
+    root = realpath(sys_root)
+    while path.startswith(root) and path != root:
+        if exists(join(path, 'idVendor')):
+            return {'vendor': read_sys_value(join(path, 'idVendor')),
+                    'product': read_sys_value(join(path, 'idProduct')),
+                    'serial': read_sys_value(join(path, 'serial')),
+                    'manufacturer': read_sys_value(join(path, 'manufacturer')),
+                    'model': read_sys_value(join(path, 'product'))}
+        path = dirname(path)
+    return None
+
+
+# Return the device paths of all detachable disks with a partition
+def get_devices(sys_root=SYS_ROOT):
+    devices = []
+    block_dir = join(sys_root, 'block')
+    if isdir(block_dir):
+        for name in os.listdir(block_dir):
+            if DEVICE_PATTERN.match(name):
+                info = get_device_info(name, sys_root)
+                if info['detachable'] and info['has_partition']:
+                    devices.append(info['path'])
+    devices.sort()
+    return devices
+
+
+# Listen to kernel uevents
+# Use fileno() with GLib.io_add_watch and call read_event when data arrives.
+class UeventMonitor(object):
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM | socket.SOCK_NONBLOCK,
+                                  NETLINK_KOBJECT_UEVENT)
+        # Multicast group 1: kernel events
+        self.sock.bind((0, 1))
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+    # Return a dictionary with the event properties or None
+    def read_event(self):
+        try:
+            data = self.sock.recv(16384)
+        except (BlockingIOError, InterruptedError):
+            return None
+        return parse_uevent(data)
+
+
+# Kernel uevents: "ACTION@DEVPATH\0KEY=VALUE\0KEY=VALUE..."
+def parse_uevent(data):
+    event = {}
+    for field in data.split(b'\0'):
+        field = field.decode('utf-8', 'replace')
+        if '=' in field:
+            key, value = field.split('=', 1)
+            event[key] = value
+    return event
+
+
+# True when the event adds, removes or changes a disk we are interested in
+def is_device_event(event):
+    if event is None or event.get('SUBSYSTEM') != 'block':
+        return False
+    if event.get('ACTION') not in ('add', 'remove', 'change'):
+        return False
+    devname = basename(event.get('DEVNAME', ''))
+    return DEVICE_PATTERN.match(devname[:3]) is not None
@@ -5,8 +5,50 @@ import gi
 gi.require_version('Gtk', '3.0')
 
 import os
+from collections import OrderedDict
 from gi.repository import Gtk, GObject, GdkPixbuf
 
+# Maximum number of decoded images that are kept
+PIXBUF_CACHE_SIZE = 128
+
+
+# Decoded (and scaled) images, shared by all tree views
+# Least recently used images are dropped when the cache is full
+class PixbufCache(object):
+    def __init__(self, maxSize=PIXBUF_CACHE_SIZE):
+        self.maxSize = maxSize
+        self.pixbufs = OrderedDict()
+
+    # Return the image of path, scaled to height (None = original size)
+    def get(self, path, height=None):
+        key = (path, height)
+        pixbuf = self.pixbufs.get(key)
+        if pixbuf is not None:
+            self.pixbufs.move_to_end(key)
+            return pixbuf
+        if height:
+            # Decode and scale in one go, keep the aspect ratio
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(path, -1, height, True)
+        else:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+        self.pixbufs[key] = pixbuf
+        while len(self.pixbufs) > self.maxSize:
+            self.pixbufs.popitem(last=False)
+        return pixbuf
+
+    def clear(self):
+        self.pixbufs.clear()
+
+
+pixbufCache = PixbufCache()
+
+# Column types by name, as used in columnTypesList
+COLUMN_TYPES = {'str': str,
+                'bool': bool,
+                'int': int,
+                'float': float,
+                'GdkPixbuf.Pixbuf': GdkPixbuf.Pixbuf}
+
 # Treeview needs subclassing of gobject
 # http://www.pygtk.org/articles/subclassing-gobject/sub-classing-gobject-in-python.htm
 
@@ -26,6 +68,8 @@ class TreeViewHandler(GObject.GObject):
         GObject.GObject.__init__(self)
         self.log = loggerObject
         self.treeview = treeView
+        # Types of the columns in the list store
+        self.columnTypes = None
 
     # Clear treeview
     def clearTreeView(self):
@@ -36,189 +80,78 @@ class TreeViewHandler(GObject.GObject):
 
     # General function to fill a treeview
     # Set setCursorWeight to 400 if you don't want bold font
+    # columnTypesList: type names ('str', 'bool', 'int', 'float', 'GdkPixbuf.Pixbuf') or types
+    # When the list store has the same columns, it is updated row by row
+    # instead of being rebuilt. With appendToExisting the rows are added.
     def fillTreeview(self, contentList, columnTypesList, setCursor=0, setCursorWeight=400, firstItemIsColName=False, appendToExisting=False, appendToTop=False, fontSize=10000, fixedImgHeight=None):
         # Check if this is a multi-dimensional array
         multiCols = self.isListOfLists(contentList)
-        colNameList = []
-
-        if len(contentList) == 0 or (len(self.treeview.get_columns()) !=  len(columnTypesList)):
-            # Empty treeview
-            self.clearTreeView()
+        columnTypes = [self.getColumnType(t) for t in columnTypesList]
 
-        liststore = self.treeview.get_model()
-        if liststore is None or not appendToExisting:
-            # Dirty but need to dynamically create a list store
-            for col in self.treeview.get_columns():
-                self.treeview.remove_column(col)
-            dynListStore = 'Gtk.ListStore('
-            for i in range(len(columnTypesList)):
-                dynListStore += str(columnTypesList[i]) + ', '
-            dynListStore += 'int, int)'
-            msg = "Create list store eval string: %(eval)s" % { "eval": dynListStore }
-            print(msg)
-            if self.log:
-                self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
-            liststore = eval(dynListStore)
-
-        # Create list with column names
-        if not appendToExisting:
-            if multiCols:
-                #for i in range(len(contentList[0])):
-                for i in range(len(columnTypesList)):
-                    if firstItemIsColName and len(contentList) > 0:
-                        msg = "First item is column name (multi-column list): %(iscolname)s" % { "iscolname": contentList[0][i] }
-                        print(msg)
-                        if self.log:
-                            self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
-                        colNameList.append(contentList[0][i])
-                    else:
-                        colNameList.append('Column ' + str(i))
-            else:
+        # Column names
+        colNameList = []
+        if multiCols:
+            for i in range(len(columnTypes)):
                 if firstItemIsColName and len(contentList) > 0:
-                    msg = "First item is column name (single-column list): %(iscolname)s" % { "iscolname": contentList[0] }
-                    print(msg)
-                    if self.log:
-                        self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
-                    colNameList.append(contentList[0])
+                    colNameList.append(str(contentList[0][i]))
                 else:
-                    colNameList.append('Column 0')
-
-            msg = "Create column names: %(cols)s" % { "cols": str(colNameList) }
-            print(msg)
-            if self.log:
-                self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
+                    colNameList.append('Column ' + str(i))
+        elif firstItemIsColName and len(contentList) > 0:
+            colNameList.append(str(contentList[0]))
+        else:
+            colNameList.append('Column 0')
 
-        # Add data to the list store
+        # Convert the rows before touching the model
+        rows = []
+        weightRow = setCursor
+        if firstItemIsColName:
+            weightRow += 1
         for i in range(len(contentList)):
             # Skip first row if that is a column name
-            skip = False
             if firstItemIsColName and i == 0:
-                msg = "First item is column name: skip first item"
-                print(msg)
-                if self.log:
-                    self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
-                skip = True
-
-            if not skip:
-                weight = 400
-                weightRow = setCursor
-                if firstItemIsColName:
-                    weightRow += 1
-                if i == weightRow:
-                    weight = setCursorWeight
-                if multiCols:
-                    # Dynamically add data for multi-column list store
-                    if appendToTop:
-                        dynListStoreAppend = 'liststore.insert(0, ['
-                    else:
-                        dynListStoreAppend = 'liststore.append(['
-                    for j in range(len(contentList[i])):
-                        val = str(contentList[i][j]).strip()
-                        if str(columnTypesList[j]) == 'str':
-                            # Make sure it's a single line
-                            val = '"' + val.replace('\n', ' ').replace('\r', '') + '"'
-                        if str(columnTypesList[j]) == 'GdkPixbuf.Pixbuf':
-                            if os.path.isfile(val):
-                                if fixedImgHeight:
-                                    pb = GdkPixbuf.Pixbuf.new_from_file(val)
-                                    nw = pb.get_width() * (fixedImgHeight / pb.get_height())
-                                    val = 'GdkPixbuf.Pixbuf.new_from_file("%(val)s").scale_simple(%(width)s, %(height)s, GdkPixbuf.InterpType.BILINEAR)' % { "val": val, "width": nw, "height": fixedImgHeight }
-                                else:
-                                    val = 'GdkPixbuf.Pixbuf.new_from_file("%(val)s")' % { "val": val }
-                            else:
-                                val = None
-                        dynListStoreAppend += '%s, ' % val
-                    dynListStoreAppend += '%s, %s])' % (str(weight), fontSize)
-
-                    msg = "Add data to list store: %(data)s" % { "data": dynListStoreAppend }
-                    #print(msg)
-                    if self.log:
-                        self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
-                    eval(dynListStoreAppend)
-                else:
-                    if appendToTop:
-                        msg = "Add data to top of list store: %(totop)s" % { "totop": str(contentList[i]) }
-                        #print(msg)
-                        if self.log:
-                            self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
-                        liststore.insert(0, [contentList[i], weight, fontSize])
-                    else:
-                        msg = "Add data to bottom of list store: %(tobottom)s" % { "tobottom": str(contentList[i]) }
-                        #print(msg)
-                        if self.log:
-                            self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
-                        liststore.append([contentList[i], weight, fontSize])
-
-        # Create columns
-        if not appendToExisting:
-            for i in range(len(colNameList)):
-                # Create a column only if it does not exist
-                colFound = ''
-                cols = self.treeview.get_columns()
-                for col in cols:
-                    if col.get_title() == colNameList[i]:
-                        colFound = col.get_title()
-                        break
+                continue
+            values = contentList[i] if multiCols else [contentList[i]]
+            row = [self.convertValue(values[j], columnTypes[j], fixedImgHeight) for j in range(len(values))]
+            row.append(setCursorWeight if i == weightRow else 400)
+            row.append(fontSize)
+            rows.append(row)
 
-                if colFound == '':
-                    # Build renderer and attributes to define the column
-                    # Possible attributes for text: text, foreground, background, weight
-                    attr = ', text=' + str(i) + ', weight=' + str(len(colNameList)) + ', size=' + str(len(colNameList) + 1)
-                    renderer = 'Gtk.CellRendererText()'  # an object that renders text into a Gtk.TreeView cell
-                    if str(columnTypesList[i]) == 'bool':
-                        renderer = 'Gtk.CellRendererToggle()'  # an object that renders a toggle button into a TreeView cell
-                        attr = ', active=' + str(i)
-                    if str(columnTypesList[i]) == 'GdkPixbuf.Pixbuf':
-                        renderer = 'Gtk.CellRendererPixbuf()'  # an object that renders a pixbuf into a Gtk.TreeView cell
-                        attr = ', pixbuf=' + str(i)
-                    dynCol = 'Gtk.TreeViewColumn("' + str(colNameList[i]) + '", ' + renderer + attr + ')'
-
-                    msg = "Create column: %(col)s" % { "col": dynCol }
-                    print(msg)
-                    if self.log:
-                        self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
-                    col = eval(dynCol)
-
-                    # Get the renderer of the column and add type specific properties
-                    rend = col.get_cells()[0]
-                    #if str(columnTypesList[i]) == 'str':
-                        # TODO: Right align text in column - add parameter to function
-                        #rend.set_property('xalign', 1.0)
-                    if str(columnTypesList[i]) == 'bool':
-                        # If checkbox column, add toggle function
-                        msg = "Check box found: add toggle function"
-                        #print(msg)
-                        if self.log:
-                            self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
-                        rend.connect('toggled', self.tvchk_on_toggle, liststore, i)
-
-                    # Let the last colum fill the treeview
-                    if i == len(colNameList):
-                        msg = "Last column fills treeview: %(colnr)d" % { "colnr": i }
-                        #print(msg)
-                        if self.log:
-                            self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
-                        col.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
-
-                    # Finally add the column
-                    self.treeview.append_column(col)
-                    msg = "Column added: %(col)s" % { "col": col.get_title() }
-                    print(msg)
-                    if self.log:
-                        self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
+        liststore = self.treeview.get_model()
+        sameColumns = liststore is not None and self.columnTypes == columnTypes and \
+                      len(self.treeview.get_columns()) == len(colNameList) and \
+                      [col.get_title() for col in self.treeview.get_columns()] == colNameList
+        if self.log:
+            self.log.write("Fill treeview: %(rows)d rows, append: %(append)s, update: %(update)s" % \
+                           { "rows": len(rows), "append": appendToExisting, "update": sameColumns },
+                           'self.treeview.fillTreeview', 'debug')
+
+        # Detach the model while filling: the view is not updated for every row
+        self.treeview.set_model(None)
+        if appendToExisting and sameColumns:
+            for row in rows:
+                if appendToTop:
+                    liststore.insert(0, row)
                 else:
-                    msg = "Column already exists: %(col)s" % { "col": colFound }
-                    print(msg)
-                    if self.log:
-                        self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
+                    liststore.append(row)
+        elif sameColumns:
+            self.updateRows(liststore, rows)
+        else:
+            for col in self.treeview.get_columns():
+                self.treeview.remove_column(col)
+            # Two extra columns: weight and font size
+            liststore = Gtk.ListStore(*(columnTypes + [int, int]))
+            if appendToTop:
+                rows.reverse()
+            for row in rows:
+                liststore.append(row)
+            self.columnTypes = columnTypes
+            self.createColumns(colNameList, columnTypes, liststore)
 
         # Add liststore, set cursor and set the headers
         self.treeview.set_model(liststore)
-        if setCursor >= 0:
+        if setCursor >= 0 and len(liststore) > 0:
             self.treeview.set_cursor(setCursor)
         self.treeview.set_headers_visible(firstItemIsColName)
-        if self.log:
-            self.log.write("Add Liststore to Treeview", 'self.treeview.fillTreeview', 'debug')
 
         # Scroll to selected cursor
         selection = self.treeview.get_selection()
@@ -226,13 +159,70 @@ class TreeViewHandler(GObject.GObject):
         if treeIter:
             path = tm.get_path(treeIter)
             self.treeview.scroll_to_cell(path)
-            msg = "Scrolled to selected row: %(row)d" % { "row": setCursor }
-            #print(msg)
-            if self.log:
-                self.log.write(msg, 'self.treeview.fillTreeview', 'debug')
+
+    # Return the type of a column type name
+    def getColumnType(self, columnType):
+        if not isinstance(columnType, str):
+            return columnType
+        if columnType not in COLUMN_TYPES:
+            raise ValueError("Unknown column type: %s" % columnType)
+        return COLUMN_TYPES[columnType]
+
+    # Convert a value to the type of its column
+    def convertValue(self, value, columnType, imgHeight=None):
+        if columnType is str:
+            # Make sure it's a single line
+            return str(value).strip().replace('\n', ' ').replace('\r', '')
+        if columnType is GdkPixbuf.Pixbuf:
+            if value is None or isinstance(value, GdkPixbuf.Pixbuf):
+                return value
+            path = str(value).strip()
+            if os.path.isfile(path):
+                return pixbufCache.get(path, imgHeight)
+            return None
+        if columnType is bool and isinstance(value, str):
+            return value.strip() == 'True'
+        return columnType(value)
+
+    # Only change the rows that differ, add or remove the rest
+    def updateRows(self, liststore, rows):
+        itr = liststore.get_iter_first()
+        for row in rows:
+            if itr is None:
+                liststore.append(row)
+                continue
+            columns = list(range(len(row)))
+            if [liststore.get_value(itr, c) for c in columns] != row:
+                liststore.set(itr, columns, row)
+            itr = liststore.iter_next(itr)
+        # remove moves the iter to the next row
+        while itr is not None and liststore.remove(itr):
+            pass
+
+    def createColumns(self, colNameList, columnTypes, liststore):
+        weightCol = len(colNameList)
+        for i in range(len(colNameList)):
+            # Build renderer and attributes to define the column
+            # Possible attributes for text: text, foreground, background, weight
+            if columnTypes[i] is bool:
+                renderer = Gtk.CellRendererToggle()
+                col = Gtk.TreeViewColumn(colNameList[i], renderer, active=i)
+                # If checkbox column, add toggle function
+                renderer.connect('toggled', self.tvchk_on_toggle, liststore, i)
+            elif columnTypes[i] is GdkPixbuf.Pixbuf:
+                renderer = Gtk.CellRendererPixbuf()
+                col = Gtk.TreeViewColumn(colNameList[i], renderer, pixbuf=i)
+            else:
+                renderer = Gtk.CellRendererText()
+                col = Gtk.TreeViewColumn(colNameList[i], renderer, text=i, weight=weightCol, size=weightCol + 1)
+            self.treeview.append_column(col)
+        if self.log:
+            self.log.write("Columns added: %(cols)s" % { "cols": str(colNameList) }, 'self.treeview.fillTreeview', 'debug')
 
     def tvchk_on_toggle(self, cell, path, liststore, colNr, *ignore):
         if path is not None:
+            # The list store can have been replaced since the column was created
+            liststore = self.treeview.get_model()
             itr = liststore.get_iter(path)
             toggled = liststore[itr][colNr]
             liststore[itr][colNr] = not toggled
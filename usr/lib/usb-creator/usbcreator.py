@@ -5,26 +5,49 @@ import gi
 gi.require_version('Gtk', '3.0')
 
 # from gi.repository import Gtk, GdkPixbuf, GObject, Pango, Gdk, GLib
-from gi.repository import Gtk, GObject
+from gi.repository import Gtk, GObject, GLib
 from os.path import join, abspath, dirname, basename, \
                     splitext, exists, expanduser, isdir
-from utils import ExecuteThreadedCommands, getoutput, \
-                  shell_exec, getPackageVersion
+from utils import shell_exec, getPackageVersion
 import os
+import time
+import threading
+import subprocess
 from glob import glob
 from datetime import datetime
 from dialogs import MessageDialog, ErrorDialog, WarningDialog, \
-                    SelectFileDialog, QuestionDialog
+                    SelectFileDialog, QuestionDialog, CheckListDialog
 from combobox import ComboBoxHandler
 from treeview import TreeViewHandler
-from queue import Queue
 from logger import Logger
+from progress import ProgressReader, PROGRESS_FD_ENV, TIMING_STAGE, timing_summary
+from isosize import IsoSizer
+from distros import KeywordMatcher
+from sysdevices import UeventMonitor, is_device_event, \
+                       get_devices as get_sys_devices
+from deviceprobe import DeviceProber, get_device_mount
 
 # i18n: http://docs.python.org/3/library/gettext.html
 import gettext
 from gettext import gettext as _
 gettext.textdomain('usb-creator')
 
+# Log file shared with usr/bin/usb-creator
+LOG_FILE = '/var/log/usb-creator.log'
+
+
+# Seconds since the process was started
+def process_age():
+    try:
+        with open('/proc/self/stat') as f:
+            # The command name can contain spaces: skip to the closing bracket
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, IOError, ValueError, IndexError):
+        return -1
+
 
 #class for the main window
 class USBCreator(object):
@@ -50,6 +73,7 @@ class USBCreator(object):
         self.txtIso = go("txtIso")
         self.btnRefresh = go("btnRefresh")
         self.btnUnmount = go("btnUnmount")
+        self.btnSelectDevices = go("btnSelectDevices")
         self.btnBrowseIso = go("btnBrowseIso")
         self.btnClear = go("btnClear")
         self.chkFormatDevice = go("chkFormatDevice")
@@ -76,20 +100,33 @@ class USBCreator(object):
         self.btnDelete.set_label("_{}".format(_("Delete")))
         self.btnRefresh.set_tooltip_text(_("Refresh device list"))
         self.btnUnmount.set_tooltip_text(_("Unmount device"))
+        self.btnSelectDevices.set_tooltip_text(_("Write to several devices at once"))
         self.btnBrowseIso.set_tooltip_text(_("Browse for ISO file"))
         self.btnClear.set_tooltip_text(_("Clear the ISO field"))
 
-        # Log lines to show: check string, percent done (0=pulse, appends last word in log line), show line (translatable)
-        self.log_lines = []
-        self.log_lines.append(["partitioning usb", 5, _("Partitioning USB...")])
-        self.log_lines.append(["searching for bad blocks", 0, _("Searching for bad block")])
-        self.log_lines.append(["installing", 15, _("Installing Grub...")])
-        self.log_lines.append(["rsync", 25, _("Start copying ISO...")])
-        self.log_lines.append(["left to copy", 0, _("kB left to copy:")])
-        self.log_lines.append(["check hash", 85, _("Check hash of ISO...")])
+        # Progress stages sent by usb-creator (see progress.py)
+        # stage: [start fraction, end fraction (None=pulse), show line (translatable)]
+        self.stages = {}
+        self.stages["partition"] = [0.0, 0.05, _("Partitioning USB...")]
+        self.stages["format"] = [0.05, 0.1, _("Formatting USB...")]
+        # The surface scan fills the whole bar before the other stages start
+        self.stages["badblocks"] = [0.0, 1.0, _("Searching for bad block")]
+        self.stages["bootloader"] = [0.1, 0.2, _("Installing Grub...")]
+        self.stages["profile"] = [0.2, None, _("Measuring the speed of the USB...")]
+        self.stages["copy"] = [0.2, 0.8, _("Copying ISO")]
+        self.stages["sync"] = [0.8, 0.85, _("Writing data to the device")]
+        self.stages["grub"] = [0.85, 0.9, _("Configuring Grub...")]
+        self.stages["hash"] = [0.9, 1.0, _("Check hash of ISO")]
+        self.progress_reader = None
+        self.progress_watch = None
+        self.progress_pulse = None
+        # Timing records of the last run
+        self.timings = []
 
         # Initiate variables
         self.devices = []
+        # Extra devices to write the same ISOs to (fan-out)
+        self.extra_devices = []
         self.device = {}
         self.device['path'] = ''
         self.device['size'] = 0
@@ -98,14 +135,20 @@ class USBCreator(object):
         self.device['available'] = 0
         self.device["new_iso"] = ''
         self.device["new_iso_required"] = 0
-        self.logos = self.get_logos()
-        self.queue = Queue(-1)
-        self.threads = {}
+        # Logos are loaded after the window is shown
+        self.logos = {}
+        self.logo_matcher = KeywordMatcher([])
+        self.iso_sizer = IsoSizer()
+        # Devices are probed in the background, results are shown on the main loop
+        self.prober = DeviceProber(deliver=GLib.idle_add)
+        self.prober.start()
+        # Running usb-creator process
+        self.process = None
         self.htmlDir = join(self.mediaDir, "html")
         self.helpFile = join(self.get_language_dir(), "help.html")
-        log = getoutput("cat /usr/bin/usb-creator | grep 'LOG=' | cut -d'=' -f 2")
-        self.log_file = log[0]
-        self.log = Logger(self.log_file, addLogTime=False, maxSizeKB=5120)
+        self.log_file = os.environ.get('USBCREATOR_LOG', LOG_FILE)
+        # The log is rotated by usr/bin/usb-creator when it starts a session
+        self.log = Logger(self.log_file, addLogTime=False)
         self.tvUsbIsosHandler = TreeViewHandler(self.tvUsbIsos)
 
         self.lblAvailable.set_label('')
@@ -114,18 +157,56 @@ class USBCreator(object):
         # Connect builder signals and show window
         self.builder.connect_signals(self)
         self.window.show_all()
+        self.startup_times = {'window': process_age()}
 
-        # Get attached devices
-        self.on_btnRefresh_clicked()
+        # Get attached devices and logos when the window is drawn
+        self.startup_start = time.monotonic()
+        GLib.idle_add(self.on_startup)
+
+        # Keep the device list up to date
+        self.uevent_monitor = None
+        self.uevent_refresh = None
+        try:
+            self.uevent_monitor = UeventMonitor()
+            GLib.io_add_watch(self.uevent_monitor.fileno(), GLib.PRIORITY_DEFAULT,
+                              GLib.IO_IN, self.on_uevent)
+        except OSError as detail:
+            self.log.write("Cannot listen to uevents: {}".format(detail), 'init')
 
         # Init log
         init_log = ">>> Start USB Creator: {} <<<".format(datetime.now())
         self.log.write(init_log)
 
-        # Version information
+        # Version information: apt-cache is slow, ask it in the background
         self.version_text = _("Version")
-        self.pck_version = getPackageVersion('usb-creator')
+        self.pck_version = ''
+        t = threading.Thread(target=self.get_version)
+        t.daemon = True
+        t.start()
+
+    def on_startup(self):
+        self.logos = self.get_logos()
+        self.logo_matcher = KeywordMatcher([[key, self.logos[key]] for key in sorted(self.logos) if key != "iso"])
+        self.on_btnRefresh_clicked()
+        # Seconds since the process started
+        self.startup_times['interactive'] = process_age()
+        self.log.write("Startup: window shown after {:.3f} s, interactive after {:.3f} s "
+                       "(deferred initialization: {:.3f} s)".format(self.startup_times['window'],
+                                                                    self.startup_times['interactive'],
+                                                                    time.monotonic() - self.startup_start), 'on_startup')
+        return False
+
+    # Runs in a thread
+    def get_version(self):
+        version = getPackageVersion('usb-creator')
+        GLib.idle_add(self.show_version, version)
+
+    def show_version(self, version):
+        self.pck_version = version
+        self.startup_times['version'] = process_age()
+        self.log.write("Startup: version known after {:.3f} s".format(self.startup_times['version']), 'show_version')
         self.set_statusbar_message("{}: {}".format(self.version_text, self.pck_version))
+        return False
 
     # ===============================================
     # Main window functions
@@ -135,6 +216,9 @@ class USBCreator(object):
         if exists(self.device["path"]):
             arguments = []
             arguments.append("-d {}".format(self.device["path"]))
+            for device in self.extra_devices:
+                if device != self.device["path"] and exists(device):
+                    arguments.append("-d {}".format(device))
             clear = self.chkFormatDevice.get_active()
             repair = self.chkRepairDevice.get_active()
             iso = self.device["new_iso"]
@@ -186,8 +270,8 @@ class USBCreator(object):
                         os.remove(iso_path)
                         self.log.write("Remove ISO: {}".format(iso_path))
                 shell_exec("usb-creator -d {} -g".format(self.device["path"]))
+                self.prober.invalidate(self.device["path"])
                 self.on_cmbDevice_changed()
-                self.fill_treeview_usbcreator(self.device["mount"])
 
     def on_btnBrowseIso_clicked(self, widget):
         file_filter = Gtk.FileFilter()
@@ -211,17 +295,17 @@ class USBCreator(object):
         iso_path = self.txtIso.get_text().strip()
         if exists(iso_path):
             if isdir(iso_path):
-                isos = glob(join(iso_path, '*.iso'))
+                # Size all ISOs in the directory and on the USB in one pass
+                isos = self.iso_sizer.scan_dir(iso_path)
                 if isos:
+                    usb_isos = {}
+                    if not self.chkFormatDevice.get_active() and self.device["mount"] != '':
+                        usb_isos = self.iso_sizer.scan_dir(self.device["mount"])
                     required = 0
-                    for iso in isos:
+                    for iso, iso_size in isos.items():
                         # Check if these ISOs overwrite current USB ISOs
-                        check_usb_iso_size = 0
-                        if not self.chkFormatDevice.get_active():
-                            check_usb_iso = join(self.device["mount"], basename(iso))
-                            if exists(check_usb_iso):
-                                check_usb_iso_size = self.get_iso_size(check_usb_iso)
-                        required += (self.get_iso_size(iso) - check_usb_iso_size)
+                        check_usb_iso = join(self.device["mount"], basename(iso))
+                        required += (iso_size - usb_isos.get(check_usb_iso, 0))
                     if required < 0:
                         required = 0
                     self.lblRequired.set_label("{}: {} MB".format(self.required_text, int(required / 1024)))
@@ -239,8 +323,8 @@ class USBCreator(object):
                 if not self.chkFormatDevice.get_active():
                     check_usb_iso = join(self.device["mount"], basename(iso_path))
                     if exists(check_usb_iso):
-                        check_usb_iso_size = self.get_iso_size(check_usb_iso)
-                required = (self.get_iso_size(iso_path) - check_usb_iso_size)
+                        check_usb_iso_size = self.iso_sizer.get_size(check_usb_iso)
+                required = (self.iso_sizer.get_size(iso_path) - check_usb_iso_size)
                 self.lblRequired.set_label("{}: {} MB".format(self.required_text, int(required / 1024)))
                 # Save the info
                 self.device["new_iso"] = iso_path
@@ -252,9 +336,52 @@ class USBCreator(object):
             self.lblRequired.set_text('')
 
     def on_btnRefresh_clicked(self, widget=None):
+        self.prober.invalidate()
         self.devices = self.get_devices()
+        self.extra_devices = [d for d in self.extra_devices if d in self.devices]
         self.cmbDeviceHandler.fillComboBox(self.devices, 0)
 
+    def on_uevent(self, fd, condition):
+        # Read all pending events and refresh once they stop coming in
+        event = self.uevent_monitor.read_event()
+        while event is not None:
+            if is_device_event(event):
+                # The disk or one of its partitions changed
+                self.prober.invalidate(join('/dev', basename(event.get('DEVNAME', ''))[:3]))
+                if self.uevent_refresh is None:
+                    self.uevent_refresh = GObject.timeout_add(500, self.refresh_after_uevent)
+            event = self.uevent_monitor.read_event()
+        return True
+
+    def refresh_after_uevent(self):
+        self.uevent_refresh = None
+        # Do not touch the device list while usb-creator is running
+        if self.process is not None:
+            return False
+        devices = get_sys_devices()
+        if devices != self.devices:
+            self.log.write("Device list changed: {}".format(devices), 'refresh_after_uevent')
+            selected = self.device['path']
+            self.devices = devices
+            self.extra_devices = [d for d in self.extra_devices if d in self.devices]
+            self.cmbDeviceHandler.fillComboBox(self.devices, selected if selected in devices else 0)
+        return False
+
+    def on_btnSelectDevices_clicked(self, widget):
+        if self.device["path"] == '':
+            return True
+        others = [d for d in self.devices if d != self.device["path"]]
+        if not others:
+            MessageDialog(self.btnSelectDevices.get_tooltip_text(), _("No other devices found."))
+            return True
+        msg = _("Select the devices to write the same ISOs to, next to {}:").format(self.device["path"])
+        selected = CheckListDialog(self.btnSelectDevices.get_tooltip_text(), msg, others, self.extra_devices).show()
+        if selected is not None:
+            self.extra_devices = selected
+            self.log.write("Extra devices: {}".format(self.extra_devices))
+            if self.extra_devices:
+                self.set_statusbar_message("{}: {}".format(_("Devices"), ", ".join([self.device["path"]] + self.extra_devices)))
+
     def on_btnUnmount_clicked(self, widget):
         unmount_text = _("Unmount")
         device = self.device["path"]
@@ -270,51 +397,27 @@ class USBCreator(object):
     def on_cmbDevice_changed(self, widget=None):
         device = self.cmbDeviceHandler.getValue()
         if device is not None:
-            mount = ''
-            size = 0
-            available = 0
-
-            # Get the size of the USB
-            usb_size = getoutput("env LANG=C udisks --show-info {} | grep size".format(device))
-            if usb_size:
-                # udisks returns bytes, while df returns kbs
-                size = int(int(usb_size[0].split(":")[1].strip()) / 1024)
-
-            # Assume that the USB is empty (will check later)
-            available = size
-
-            # Get free size on USB
-            has_partition = self.device_has_partition(device)
-            if has_partition:
-                mount = self.get_device_mount(device)
-                # This function can be called from on_chkFormatDevice_toggled
-                if widget != self.chkFormatDevice:
-                    self.chkFormatDevice.set_sensitive(True)
-                    self.chkFormatDevice.set_active(False)
-                    free_size = getoutput("df --output=avail {}1 | awk 'NR==2'".format(device))
-                    if free_size:
-                        available = int(free_size[0])
+            snapshot = self.prober.get_cached(device)
+            if snapshot is not None:
+                self.prober.cancel()
+                self.show_device(snapshot, widget)
             else:
-                self.chkFormatDevice.set_active(True)
-                self.chkFormatDevice.set_sensitive(False)
-
-            self.chkRepairDevice.set_active(False)
-            self.fill_treeview_usbcreator(mount)
-            self.lblAvailable.set_label("{}: {} MB".format(self.available_text, int(available / 1024)))
-
-            # Save the info
-            self.device['path'] = device
-            self.device['size'] = size
-            self.device['has_partition'] = has_partition
-            self.device['mount'] = mount
-            self.device['available'] = available
-            self.log.write("Selected device info: {}".format(self.device))
-
-            # Update info
-            iso_path = self.txtIso.get_text().strip()
-            if iso_path != "" and exists(iso_path):
-                self.on_txtIso_changed()
+                # Forget the previous device: Execute and Delete must not act on it
+                # while this device is read. show_device enables them again.
+                self.device['path'] = device
+                self.device['size'] = 0
+                self.device['has_partition'] = False
+                self.device['mount'] = ''
+                self.device['available'] = 0
+                self.btnExecute.set_sensitive(False)
+                self.btnDelete.set_sensitive(False)
+                # Mounting and reading the device is done in the background
+                self.statusbar.push(self.statusbar.get_context_id('probe'),
+                                    _("Reading device {}...").format(device))
+                self.prober.probe(device, lambda snapshot: self.show_device(snapshot, widget))
         else:
+            self.prober.cancel()
+            self.statusbar.remove_all(self.statusbar.get_context_id('probe'))
             self.fill_treeview_usbcreator()
             self.lblAvailable.set_label('')
             self.lblRequired.set_label('')
@@ -327,6 +430,56 @@ class USBCreator(object):
             self.device["new_iso"] = ''
             self.device["new_iso_required"] = 0
 
+    # Show the device snapshot of the prober (see deviceprobe.py)
+    def show_device(self, snapshot, widget=None):
+        device = snapshot['path']
+        if device != self.cmbDeviceHandler.getValue():
+            # The selection changed in the mean time
+            return False
+        if 'error' in snapshot:
+            self.log.write("Cannot probe {}: {}".format(device, snapshot['error']), 'show_device')
+        mount = snapshot['mount']
+        # Sizes in kB
+        size = snapshot['size']
+
+        # Assume that the USB is empty (will check later)
+        available = size
+
+        # Get free size on USB
+        has_partition = snapshot['has_partition']
+        if has_partition:
+            # This function can be called from on_chkFormatDevice_toggled
+            if widget != self.chkFormatDevice:
+                self.chkFormatDevice.set_sensitive(True)
+                self.chkFormatDevice.set_active(False)
+                if snapshot['available'] is not None:
+                    available = snapshot['available']
+        else:
+            self.chkFormatDevice.set_active(True)
+            self.chkFormatDevice.set_sensitive(False)
+
+        self.chkRepairDevice.set_active(False)
+        self.fill_treeview_usbcreator(mount, snapshot['isos'])
+        self.lblAvailable.set_label("{}: {} MB".format(self.available_text, int(available / 1024)))
+
+        # Save the info
+        self.device['path'] = device
+        self.device['size'] = size
+        self.device['has_partition'] = has_partition
+        self.device['mount'] = mount
+        self.device['available'] = available
+        self.log.write("Selected device info: {}".format(self.device))
+        self.btnExecute.set_sensitive(True)
+        self.btnDelete.set_sensitive(True)
+        # Show the previous message again
+        self.statusbar.remove_all(self.statusbar.get_context_id('probe'))
+
+        # Update info
+        iso_path = self.txtIso.get_text().strip()
+        if iso_path != "" and exists(iso_path):
+            self.on_txtIso_changed()
+        return False
+
     def on_chkFormatDevice_toggled(self, widget):
         # Recalculate available space and requied space
         self.on_cmbDevice_changed(widget)
@@ -335,25 +488,21 @@ class USBCreator(object):
         # Open the help file as the real user (not root)
         shell_exec("%s/open-as-user \"%s\"" % (self.scriptDir, self.helpFile))
 
-    def fill_treeview_usbcreator(self, mount=''):
+    def fill_treeview_usbcreator(self, mount='', isos=None):
         isos_list = []
         # columns: checkbox, image (logo), device, driver
         column_types = ['bool', 'GdkPixbuf.Pixbuf', 'str', 'str']
 
         if exists(mount):
-            isos = glob(join(mount, '*.iso'))
-            for iso in isos:
+            if isos is None:
+                isos = self.iso_sizer.scan_dir(mount)
+            for iso in sorted(isos):
                 iso_name = basename(iso)
-                iso_name_lower = iso_name.lower()
-                iso_size = "{} MB".format(int(self.get_iso_size(iso) / 1024))
-                iso_logo = ""
-                for key, logo in list(self.logos.items()):
-                    if key != "iso":
-                        if key in iso_name_lower:
-                            if len(logo) > len(iso_logo):
-                                iso_logo = logo
-                if iso_logo == "":
-                    iso_logo = self.logos["iso"]
+                iso_size = "{} MB".format(int(isos[iso] / 1024))
+                # Longest logo name found in the ISO name
+                iso_logo = self.logo_matcher.longest(iso_name)[1]
+                if iso_logo is None:
+                    iso_logo = self.logos.get("iso")
                 self.log.write("ISO on {}: {}, {}, {}".format(mount, iso_name, iso_size, iso_logo))
                 isos_list.append([False, iso_logo, iso_name, iso_size])
 
@@ -362,41 +511,49 @@ class USBCreator(object):
 
     def exec_command(self, command):
         try:
-            # Run the command in a separate thread
+            # Run the command in the background: the main loop is woken up
+            # by progress events and when the command exits
             self.set_buttons_state(False)
-            name = 'cmd'
-            t = ExecuteThreadedCommands([command], self.queue)
-            self.threads[name] = t
-            t.daemon = True
-            t.start()
-            self.queue.join()
-            GObject.timeout_add(1000, self.check_thread, name)
+            # Pass the write end of the progress pipe to usb-creator
+            read_fd, write_fd = os.pipe()
+            self.progress_reader = ProgressReader(read_fd)
+            self.timings = []
+            env = os.environ.copy()
+            env[PROGRESS_FD_ENV] = str(write_fd)
+            try:
+                self.process = subprocess.Popen(command, shell=True, env=env, pass_fds=(write_fd,))
+            finally:
+                os.close(write_fd)
+            self.progress_watch = GLib.io_add_watch(read_fd, GLib.PRIORITY_DEFAULT,
+                                                    GLib.IO_IN | GLib.IO_HUP, self.on_progress)
+            GLib.child_watch_add(GLib.PRIORITY_DEFAULT, self.process.pid, self.on_command_exit)
 
         except Exception as detail:
+            self.close_progress()
+            self.set_buttons_state(True)
             ErrorDialog(self.btnExecute.get_label(), detail)
 
-    def check_thread(self, name):
-        if self.threads[name].is_alive():
-            self.set_progress()
-            if not self.queue.empty():
-                ret = self.queue.get()
-                self.log.write("Queue returns: {}".format(ret), 'check_thread')
-                self.queue.task_done()
-                self.show_message(ret)
-            return True
-
-        # Thread is done
-        self.log.write(">> Thread is done", 'check_thread')
-        if not self.queue.empty():
-            ret = self.queue.get()
-            self.queue.task_done()
-            self.show_message(ret)
-        del self.threads[name]
+    def on_progress(self, fd, condition):
+        self.set_progress()
+        if condition & GLib.IO_HUP and not condition & GLib.IO_IN:
+            # All writers are gone
+            self.progress_watch = None
+            return False
+        return True
+
+    def on_command_exit(self, pid, status):
+        # GLib has reaped the child: tell Popen
+        ret = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 255
+        self.process.returncode = ret
+        self.process = None
+        self.log.write(">> Command is done: {}".format(ret), 'on_command_exit')
+        self.close_progress()
+        self.show_message(ret)
         self.set_buttons_state(True)
+        self.prober.invalidate()
         self.on_cmbDevice_changed()
-        self.fill_treeview_usbcreator(self.device["mount"])
         self.set_statusbar_message("{}: {}".format(self.version_text, self.pck_version))
-        return False
+        self.show_timings()
 
     def set_buttons_state(self, enable):
         if not enable:
@@ -406,6 +563,7 @@ class USBCreator(object):
             self.btnBrowseIso.set_sensitive(False)
             self.btnRefresh.set_sensitive(False)
             self.btnUnmount.set_sensitive(False)
+            self.btnSelectDevices.set_sensitive(False)
             self.btnClear.set_sensitive(False)
             self.chkFormatDevice.set_sensitive(False)
             self.chkRepairDevice.set_sensitive(False)
@@ -418,6 +576,7 @@ class USBCreator(object):
             self.btnBrowseIso.set_sensitive(True)
             self.btnRefresh.set_sensitive(True)
             self.btnUnmount.set_sensitive(True)
+            self.btnSelectDevices.set_sensitive(True)
             self.btnClear.set_sensitive(True)
             self.chkFormatDevice.set_sensitive(True)
             self.chkRepairDevice.set_sensitive(True)
@@ -435,30 +594,74 @@ class USBCreator(object):
         return logos_dict
 
     def set_progress(self):
-        if exists(self.log_file):
-            msg = ''
-            last_line = getoutput("tail -50 {} | grep -v DEBUG | grep -v ==".format(self.log_file))
-            for line in reversed(last_line):
-                # Check for session start line: that is the last line to check
-                if ">>>>>" in line and "<<<<<" in line:
-                    break
-                for chk_line in self.log_lines:
-                    if chk_line[0] in line.lower():
-                        #print((line))
-                        word = ''
-                        if chk_line[1] == 0:
-                            self.pbUsbCreator.pulse()
-                            words = line.split(' ')
-                            for word in reversed(words):
-                                if word.strip() != '':
-                                    break
-                        else:
-                            self.pbUsbCreator.set_fraction(float(chk_line[1] / 100))
-                        msg = "{} {}".format(chk_line[2], word)
-                        break
-                if msg != '':
-                    break
-            self.set_statusbar_message(msg)
+        if self.progress_reader is not None:
+            for event in self.progress_reader.read_events():
+                self.show_progress_event(event)
+
+    # Stages without progress pulse the progress bar until the next event
+    def set_pulse(self, pulse):
+        if pulse and self.progress_pulse is None:
+            self.progress_pulse = GLib.timeout_add(250, self.on_pulse)
+        elif not pulse and self.progress_pulse is not None:
+            GLib.source_remove(self.progress_pulse)
+            self.progress_pulse = None
+
+    def on_pulse(self):
+        self.pbUsbCreator.pulse()
+        return True
+
+    def show_progress_event(self, event):
+        if event['stage'] == TIMING_STAGE:
+            self.timings.append(event)
+            return
+        stage = self.stages.get(event['stage'])
+        if stage is None:
+            return
+        start, end, msg = stage
+        if event.get('item'):
+            msg = "{} {}".format(msg, event['item'])
+        self.set_pulse(end is None)
+        total = event.get('total', 0)
+        if end is None:
+            self.pbUsbCreator.pulse()
+        elif total > 0:
+            fraction = min(event.get('done', 0) / total, 1.0)
+            self.pbUsbCreator.set_fraction(start + (end - start) * fraction)
+            msg = "{}: {}%".format(msg, int(fraction * 100))
+            if event.get('rate', 0) > 0:
+                msg = "{} ({} MB/s".format(msg, event['rate'])
+                if event.get('eta', -1) >= 0:
+                    msg = "{}, {}:{:02d} {}".format(msg, int(event['eta'] / 60), event['eta'] % 60, _("left"))
+                msg += ")"
+        else:
+            self.pbUsbCreator.set_fraction(start)
+        self.set_statusbar_message(msg)
+
+    def close_progress(self):
+        self.set_pulse(False)
+        if self.progress_watch is not None:
+            GLib.source_remove(self.progress_watch)
+            self.progress_watch = None
+        if self.progress_reader is not None:
+            # Show the last events
+            self.set_progress()
+            self.progress_reader.close()
+            self.progress_reader = None
+
+    def show_timings(self):
+        # Log every step and show where the time went
+        if not self.timings:
+            return
+        for record in self.timings:
+            self.log.write("Timing: {}".format(record), 'show_timings')
+        summary = []
+        for name, seconds, size in timing_summary(self.timings):
+            text = "{} {:.1f} s".format(name, seconds)
+            if size >= 1048576 and seconds > 0:
+                text = "{} ({:.1f} MB/s)".format(text, size / seconds / 1048576)
+            summary.append(text)
+        self.log.write("Timing summary: {}".format(", ".join(summary)), 'show_timings')
+        self.set_statusbar_message("{}: {}".format(_("Time"), ", ".join(summary[:4])))
 
     def set_statusbar_message(self, message):
         if message is not None:
@@ -466,42 +669,11 @@ class USBCreator(object):
             self.statusbar.push(context, message)
 
     def get_devices(self):
-        devices = []
-        my_devices = getoutput("udisks --enumerate-device-files | egrep '/dev/sd[a-z]$'")
-        for device in my_devices:
-            info = getoutput("env LANG=C udisks --show-info {}".format(device))
-            detachable = False
-            has_partition = False
-            for line in info:
-                if "detachable" in line and "1" in line:
-                    detachable = True
-                elif "partition" in line:
-                    has_partition = True
-                if detachable and has_partition:
-                    devices.append(device)
-                    break
-        devices.sort()
-        return devices
-
-    def device_has_partition(self, device):
-        part_count = getoutput("udisks --show-info {} | grep count | grep -v block".format(device))
-        if part_count:
-            if "1" in part_count[0]:
-                return True
-        return False
+        # Detachable disks with a partition, read from sysfs
+        return get_sys_devices()
 
     def get_device_mount(self, device):
-        shell_exec("udisks --mount {}1".format(device))
-        mount = getoutput("grep %s1 /etc/mtab | awk '{print $2}' | sed 's/\\040/ /g'" % device)
-        if mount:
-            return mount[0]
-        return ''
-
-    def get_iso_size(self, iso):
-        iso_size = getoutput("du -Lk \"%s\" | awk '{print $1}'" % iso)
-        if iso_size:
-            return int(iso_size[0])
-        return 0
+        return get_device_mount(device)
 
     def unmount_device(self, device):
         shell_exec("udisks --unmount {}1".format(device))
@@ -513,6 +685,8 @@ class USBCreator(object):
         for device in self.devices:
             if self.get_device_mount(device) != "":
                 self.unmount_device(device)
+        # Write the queued log messages
+        self.log.close()
         # Close the app
         Gtk.main_quit()
 
@@ -544,6 +718,11 @@ class USBCreator(object):
                 elif ret == 11:
                     ErrorDialog(self.btnExecute.get_label(), _("Unable to guess distribution from ISO name.\n"
                                                                "Make sure you have the distribution name in the ISO name."))
+                elif ret == 12:
+                    ErrorDialog(self.btnExecute.get_label(), _("Writing to the device failed."))
+                elif ret == 13:
+                    ErrorDialog(self.btnExecute.get_label(), _("The surface scan of the device failed or found too few usable blocks.\n"
+                                                               "The device may be damaged or counterfeit."))
                 else:
                     msg = _("An unknown error accured.\n"
                             "Please, visit our forum for support: http://forums.solydxk.com")